@@ -0,0 +1,64 @@
+""" A stand-in transport, which serves authorized_keys files from a local
+    directory instead of from remote servers.
+
+    The file of user on hostname is root/hostname/user.  Every round trip
+    takes latency seconds and fails (transiently) with probability
+    failure_rate. """
+import sys
+import time
+import random
+import hashlib
+import os.path
+import functools
+import threading
+
+import claviger.scp
+
+class FakeSCP(claviger.scp.SCP):
+    def __init__(self, root, latency=0.0, failure_rate=0.0, seed=0, **kwargs):
+        kwargs['multiplex'] = False
+        super(FakeSCP, self).__init__(**kwargs)
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def connect(self, hostname, port, ssh_user):
+        return FakeSession(hostname, port, ssh_user, self)
+
+    def fails(self):
+        with self._random_lock:
+            return self._random.random() < self.failure_rate
+
+class FakeSession(claviger.scp.SCPSession):
+    def _path_for(self, user):
+        return os.path.join(self.scp.root, self.hostname, user)
+    def _roundtrip(self):
+        time.sleep(self.scp.latency)
+        if self.scp.fails():
+            raise claviger.scp.TransientSCPError('fake failure')
+    def discover(self, user):
+        self._roundtrip()
+        return self._path_for(user)
+    def digest(self, user):
+        self._roundtrip()
+        with open(self._path_for(user), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    def get(self, user):
+        self._roundtrip()
+        with open(self._path_for(user), 'rb') as f:
+            return f.read()
+    def put(self, user, authorized_keys):
+        self._roundtrip()
+        with open(self._path_for(user), 'wb') as f:
+            f.write(authorized_keys)
+
+def register(root, latency=0.0, failure_rate=0.0, seed=0):
+    """ Makes the fake transport available as `--transport fake' """
+    claviger.scp.TRANSPORTS['fake'] = functools.partial(FakeSCP, root,
+                                            latency, failure_rate, seed)
+    if sys.version_info >= (3, 5):
+        # The asyncio engine, and with it fakessh_aio, needs Python 3.5.
+        import fakessh_aio
+        fakessh_aio.register(root, latency, failure_rate, seed)
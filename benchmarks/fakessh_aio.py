@@ -0,0 +1,41 @@
+""" The fake transport of fakessh.py for the asyncio engine. """
+import asyncio
+import hashlib
+import functools
+
+import claviger.aio
+import claviger.scp
+
+from fakessh import FakeSCP, FakeSession
+
+class AsyncFakeSCP(FakeSCP):
+    def connect(self, hostname, port, ssh_user):
+        return AsyncFakeSession(hostname, port, ssh_user, self)
+
+class AsyncFakeSession(FakeSession, claviger.aio.AsyncSCPSession):
+    async def _async_roundtrip(self):
+        await asyncio.sleep(self.scp.latency)
+        if self.scp.fails():
+            raise claviger.scp.TransientSCPError('fake failure')
+    async def discover(self, user):
+        await self._async_roundtrip()
+        return self._path_for(user)
+    async def digest(self, user):
+        await self._async_roundtrip()
+        with open(self._path_for(user), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    async def get(self, user):
+        await self._async_roundtrip()
+        with open(self._path_for(user), 'rb') as f:
+            return f.read()
+    async def put(self, user, authorized_keys):
+        await self._async_roundtrip()
+        with open(self._path_for(user), 'wb') as f:
+            f.write(authorized_keys)
+    async def close(self):
+        pass
+
+def register(root, latency=0.0, failure_rate=0.0, seed=0):
+    """ Like fakessh.register, for --engine asyncio """
+    claviger.aio.TRANSPORTS['fake'] = functools.partial(AsyncFakeSCP, root,
+                                            latency, failure_rate, seed)
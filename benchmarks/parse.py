@@ -0,0 +1,55 @@
+""" Compares the speed of Entry.parse with the original parser.
+
+    Both are first checked to agree on a fuzzed corpus.  Then both are
+    timed on the fuzzed corpus and on a corpus of typical lines with
+    RSA-4096 keys, half of them with options.  Run as
+
+        python benchmarks/parse.py [number of lines] """
+import sys
+import base64
+import random
+import struct
+import timeit
+
+import claviger.authorized_keys
+from claviger.tests.test_authorized_keys import (fuzzed_corpus,
+                                                 reference_parse)
+
+def parse(line):
+    try:
+        e = claviger.authorized_keys.Entry.parse(line)
+    except claviger.authorized_keys.CouldNotParseLine:
+        return None
+    return (e.options, e.keytype, e.key, e.comment)
+
+def typical_corpus(n, seed=0):
+    rnd = random.Random(seed)
+    options = (b'from="10.0.0.0/8,192.168.1.1",no-pty,no-port-forwarding,'
+               b'command="/usr/local/bin/backup --target /srv/backup"')
+    ret = []
+    for i in range(n):
+        blob = (struct.pack('>I', 7) + b'ssh-rsa'
+                    + bytes(bytearray(rnd.randrange(256) for _ in range(524))))
+        line = b'ssh-rsa ' + base64.b64encode(blob) + b' user@host'
+        ret.append(options + b' ' + line if i % 2 else line)
+    return ret
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    corpus = fuzzed_corpus(n)
+    mismatches = [line for line in corpus
+                    if parse(line) != reference_parse(line)]
+    print('{0} lines, {1} parse, {2} mismatches'.format(len(corpus),
+                sum(1 for line in corpus if parse(line) is not None),
+                len(mismatches)))
+    for corpus_name, corpus in (('fuzzed', corpus),
+                                ('typical', typical_corpus(n))):
+        for name, func in (('reference', reference_parse), ('current', parse)):
+            t = min(timeit.repeat(lambda: [func(line) for line in corpus],
+                                  number=1, repeat=5))
+            print('{0:<8} {1:<10} {2:8.1f} us/line'.format(corpus_name, name,
+                                        t / len(corpus) * 1e6))
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+""" Benchmarks claviger against a synthetic fleet.
+
+    Generates a configuration with the given number of servers and keys,
+    in which servers inherit through a chain of abstract stanzas, and
+    authorized_keys files for all servers, which are served by the fake
+    transport of fakessh.py.  Then reports wall time and peak memory of
+    config.load, authorized_keys.parse and Claviger.check_servers and the
+    latencies per server.  Run as
+
+        python benchmarks/run.py --servers 1000 --latency 0.05 -p 64 """
+import os
+import sys
+import time
+import base64
+import random
+import shutil
+import struct
+import os.path
+import argparse
+import tempfile
+import tracemalloc
+
+import yaml
+
+import claviger.main
+import claviger.config
+import claviger.authorized_keys
+
+import fakessh
+
+def random_key(rnd, name):
+    blob = (struct.pack('>I', 11) + b'ssh-ed25519' + struct.pack('>I', 32)
+                + bytes(bytearray(rnd.randrange(256) for _ in range(32))))
+    return 'ssh-ed25519 {0} {1}'.format(base64.b64encode(blob).decode(), name)
+
+def generate(root, n_servers, n_keys, depth, keys_per_stanza, seed=0):
+    """ Writes a configuration file and authorized_keys files to root.
+        Returns the path of the configuration file. """
+    rnd = random.Random(seed)
+    keys = {'key{0}'.format(i): random_key(rnd, 'key{0}'.format(i))
+                for i in range(n_keys)}
+    key_names = sorted(keys)
+    servers = {}
+    for level in range(depth):
+        servers['$level{0}'.format(level)] = {
+                'like': '$level{0}'.format(level - 1) if level else '$default',
+                'present': rnd.sample(key_names, keys_per_stanza)}
+    for i in range(n_servers):
+        hostname = 'host{0}'.format(i)
+        present = rnd.sample(key_names, keys_per_stanza)
+        servers[hostname] = {'like': '$level{0}'.format(rnd.randrange(depth))
+                                        if depth else '$default',
+                             'present': present,
+                             'absent': [k for k in rnd.sample(key_names,
+                                                keys_per_stanza)
+                                            if k not in present]}
+        os.mkdir(os.path.join(root, hostname))
+        lines = [keys[k] for k in rnd.sample(key_names, keys_per_stanza)]
+        lines += [random_key(rnd, 'unknown{0}'.format(j)) for j in range(3)]
+        with open(os.path.join(root, hostname, 'root'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    path = os.path.join(root, 'claviger.yml')
+    with open(path, 'w') as f:
+        yaml.safe_dump({'keys': keys, 'servers': servers}, f)
+    return path
+
+def measure(func, trace_memory=True):
+    """ Returns (result, wall time, peak memory) of calling func.  Peak
+        memory is None if not trace_memory. """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    ret = func()
+    duration = time.time() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return ret, duration, peak
+
+def report(name, duration, peak):
+    if peak is None:
+        print('{0:<24} {1:9.1f} ms'.format(name, duration * 1000))
+        return
+    print('{0:<24} {1:9.1f} ms {2:9.1f} MB'.format(name, duration * 1000,
+                                                   peak / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark claviger')
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--keys', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Length of the chain of abstract stanzas')
+    parser.add_argument('--keys-per-stanza', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds per round trip')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--retries', type=int, default=0)
+    parser.add_argument('--engine', default='threads')
+    parser.add_argument('-p', '--parallel-connections', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--apply-changes', '-f', action='store_true')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='claviger-bench-')
+    try:
+        path = generate(root, args.servers, args.keys, args.depth,
+                        args.keys_per_stanza)
+        fakessh.register(root, args.latency, args.failure_rate)
+
+        cfg, duration, peak = measure(
+                    lambda: claviger.config.load(path, use_cache=False))
+        report('config.load', duration, peak)
+
+        raw_files = []
+        for server in cfg['servers'].values():
+            if not server['abstract']:
+                with open(os.path.join(root, server['hostname'],
+                                       'root'), 'rb') as f:
+                    raw_files.append(f.read())
+        _, duration, peak = measure(lambda: [
+                    claviger.authorized_keys.parse(raw) for raw in raw_files])
+        report('authorized_keys.parse', duration, peak)
+
+        c = claviger.main.Claviger()
+        c.parse_commandline_args(['-c', path, '--transport', 'fake',
+                    '--engine', args.engine, '--no-cache', '-s',
+                    '-p', str(args.parallel_connections),
+                    '--retries', str(args.retries),
+                    '--processes', str(args.processes)]
+                    + (['-f'] if args.apply_changes else []))
+        c.cfg = cfg
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            # Forked processes would inherit (and pay for) the tracing,
+            # while their memory would not be counted.
+            _, duration, peak = measure(c.check_servers,
+                                        trace_memory=args.processes == 1)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        report('check_servers', duration, peak)
+        print('{0:<24} {1:9.1f} servers/s'.format('throughput',
+                                                  args.servers / duration))
+        c.profile.write(sys.stdout, 5)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
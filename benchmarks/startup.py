@@ -0,0 +1,72 @@
+""" Benchmarks the startup time of claviger.
+
+    Reports the median wall time of importing claviger.main and of a run
+    that checks no servers, once with and once without the processed
+    configuration in the cache.  The latter is what a short run from cron
+    costs on top of checking the servers.  Exits with status 1 if the run
+    with the cache takes longer than --target milliseconds.  Run as
+
+        python benchmarks/startup.py --servers 1000 --target 250 """
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import claviger.config
+
+import run
+
+def median_duration(cmd, env, repeat):
+    """ Returns the median wall time of running cmd repeat times. """
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, env=env, stdout=devnull,
+                                  stderr=devnull)
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark startup time')
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--keys', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=11)
+    parser.add_argument('--target', type=float, default=250,
+                        help='Maximum milliseconds of a cached run')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='claviger-bench-')
+    try:
+        path = run.generate(root, args.servers, args.keys, depth=3,
+                            keys_per_stanza=5)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(root, 'cache')
+        env = dict(os.environ)
+        # A pattern that matches no server: we only measure startup.
+        cmd = [sys.executable, '-m', 'claviger.main', '-c', path,
+               'no-such-server']
+        results = [
+            ('import', median_duration([sys.executable, '-c',
+                                'import claviger.main'], env, args.repeat)),
+            ('run without cache', median_duration(cmd + ['--no-cache'],
+                                env, args.repeat)),
+        ]
+        # A run that selects servers does not fill the cache.
+        claviger.config.load(path)
+        results.append(('run with cache', median_duration(cmd, env,
+                                                          args.repeat)))
+    finally:
+        shutil.rmtree(root)
+    for name, duration in results:
+        print('{0:<24} {1:9.1f} ms'.format(name, duration * 1000))
+    if results[-1][1] * 1000 > args.target:
+        print('run with cache exceeds target of {0} ms'.format(args.target))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,13 +15,10 @@ setup(
     url='http://github.com/bwesterb/claviger/',
     packages=['claviger', 'claviger.tests'],
     package_dir={'claviger': 'src'},
-    package_data={'claviger': [
-                    'config.schema.yml']},
     test_suite='claviger.tests',
     license='GPL 3.0',
     zip_safe=False,
-    install_requires=['demandimport >=0.3.0',
-                      'PyYAML',
+    install_requires=['PyYAML',
                       'six',
                       'tarjan',
                       'jsonschema',
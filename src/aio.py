@@ -0,0 +1,240 @@
+""" asyncio execution engine.
+
+    Instead of blocking a thread per connection, all scp and ssh processes
+    are driven from a single event loop.  This allows for thousands of
+    concurrent connections from one process.  Requires Python 3.5. """
+
+import asyncio
+import logging
+import tempfile
+
+import claviger.scp
+import claviger.timing
+import claviger.worker
+
+l = logging.getLogger(__name__)
+
+class AsyncSCP(claviger.scp.SCP):
+    def connect(self, hostname, port,  ssh_user):
+        return AsyncSCPSession(hostname, port, ssh_user, self)
+
+class AsyncSSH(claviger.scp.SSH):
+    def connect(self, hostname, port,  ssh_user):
+        return AsyncSSHSession(hostname, port, ssh_user, self)
+
+# Maps the names of the transports to their classes
+TRANSPORTS = {'scp': AsyncSCP, 'ssh': AsyncSSH}
+
+async def _within(timeout, p, coro, program):
+    """ Awaits coro, but kills the process p and raises SCPTimeout if that
+        takes longer than timeout seconds. """
+    if timeout is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, max(timeout, 0))
+    except asyncio.TimeoutError:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            pass
+        await p.wait()
+        raise claviger.scp.SCPTimeout('{0} timed out'.format(program))
+
+class AsyncSCPSession(claviger.scp.SCPSession):
+    """ Like claviger.scp.SCPSession, but the methods that talk to the
+        server are coroutines. """
+    async def _run(self, cmd):
+        l.debug('executing %s', cmd)
+        p = await asyncio.create_subprocess_exec(*cmd,
+                                stdout=asyncio.subprocess.PIPE,
+                                stderr=asyncio.subprocess.PIPE)
+        stdout_txt, stderr_txt = [x.decode('utf-8') for x in await _within(
+                            self.scp.timeout, p, p.communicate(), cmd[0])]
+        if p.returncode != 0:
+            raise claviger.scp.interpret_scp_error(p.returncode,
+                                    stderr_txt, stdout_txt, cmd[0])
+        return stdout_txt
+    async def _scp(self, src, trg):
+        await self._run(self._scp_cmd(src, trg))
+    async def digest(self, user):
+        return claviger.scp.parse_digest(
+                    await self._run(self._digest_cmd(user)))
+    async def discover(self, user):
+        path = claviger.scp.parse_discovery(
+                    await self._run(self._discover_cmd(user)), user)
+        if path is not None:
+            self.paths[user] = path
+        return path
+    async def get(self, user):
+        with tempfile.NamedTemporaryFile() as tempf:
+            await self._scp(self._remote_path(user), tempf.name)
+            return tempf.read()
+    async def put(self, user, authorized_keys):
+        with tempfile.NamedTemporaryFile() as tempf:
+            tempf.write(authorized_keys)
+            tempf.flush()
+            await self._scp(tempf.name, self._remote_path(user))
+    async def get_many(self, users):
+        return [await self.get(user) for user in users]
+    async def put_many(self, users, authorized_keyss):
+        for user, authorized_keys in zip(users, authorized_keyss):
+            if authorized_keys is not None:
+                await self.put(user, authorized_keys)
+    async def close(self):
+        pass
+
+class AsyncSSHSession(claviger.scp.SSHSession, AsyncSCPSession):
+    """ Like claviger.scp.SSHSession, but get, put, get_many, put_many and
+        close are coroutines.  The other methods are those of
+        AsyncSCPSession. """
+    def _remaining(self):
+        """ Returns the time left before the ssh process should be killed """
+        if not self.scp.timeout:
+            return None
+        return self._deadline - asyncio.get_event_loop().time()
+    async def get(self, user):
+        return (await self.get_many([user]))[0]
+    async def put(self, user, authorized_keys):
+        await self.put_many([user], [authorized_keys])
+    async def get_many(self, users):
+        if self._p is not None:
+            raise claviger.scp.SCPError('SSHSession can only handle one get')
+        cmd = self._get_cmd(users)
+        l.debug('executing %s', cmd)
+        self._stderr = tempfile.TemporaryFile()
+        self._p = await asyncio.create_subprocess_exec(*cmd,
+                                stdin=asyncio.subprocess.PIPE,
+                                stdout=asyncio.subprocess.PIPE,
+                                stderr=self._stderr)
+        if self.scp.timeout:
+            self._deadline = (asyncio.get_event_loop().time()
+                                    + self.scp.timeout)
+        self._users = list(users)
+        ret = []
+        try:
+            for user in users:
+                size = int(await _within(self._remaining(), self._p,
+                                         self._p.stdout.readline(), 'ssh'))
+                ret.append(await _within(self._remaining(), self._p,
+                                    self._p.stdout.readexactly(size), 'ssh'))
+        except claviger.scp.SCPTimeout:
+            # _within killed ssh: there is nothing left to finish.
+            self._p = None
+            self._stderr.close()
+            raise
+        except (ValueError, asyncio.IncompleteReadError):
+            try:
+                await self._finish(b'')
+            except claviger.scp.SCPError as e:
+                raise claviger.scp.unexpected_output_error(e)
+            raise claviger.scp.unexpected_output_error(None)
+        return ret
+    async def put_many(self, users, authorized_keyss):
+        if self._p is None or list(users) != self._users:
+            raise claviger.scp.SCPError(
+                        'SSHSession: put without matching get')
+        await self._finish(self._put_cmd(authorized_keyss))
+    async def close(self):
+        if self._p is not None:
+            await self._finish(self._put_cmd([None] * len(self._users)))
+    async def _finish(self, stdin_data):
+        p, self._p = self._p, None
+        stdout = (await _within(self._remaining(), p,
+                        p.communicate(stdin_data), 'ssh'))[0].decode('utf-8')
+        stderr = claviger.scp.read_stderr(self._stderr)
+        if p.returncode != 0:
+            raise claviger.scp.interpret_scp_error(p.returncode,
+                                    stderr, stdout, 'ssh')
+
+async def check_server(job, scp):
+    """ Coroutine version of claviger.worker.check_server """
+    server = job.server
+    stopwatch = claviger.timing.Stopwatch()
+    def job_return(ok, result):
+        return claviger.worker.JobReturn(server_name=server['name'], ok=ok,
+                                         result=result,
+                                         duration=stopwatch.total(),
+                                         timings=stopwatch.timings)
+    attempt = 0
+    while True:
+        try:
+            return job_return(True, await _check_server(job, scp, stopwatch))
+        except claviger.scp.TransientSCPError as e:
+            stopwatch.lap('error')
+            attempt += 1
+            delay = scp.retry_delay(attempt)
+            if delay is None:
+                return job_return(False, e)
+            await asyncio.sleep(delay)
+            stopwatch.lap('backoff')
+        except claviger.scp.SCPError as e:
+            stopwatch.lap('error')
+            return job_return(False, e)
+
+async def _check_server(job, scp, stopwatch):
+    """ Coroutine version of claviger.worker._check_server """
+    server = job.server
+    users = server['users']
+    conn = scp.connect(server['hostname'], server['port'],
+                                server['ssh_user'])
+    try:
+        paths = {}
+        for user in users:
+            if job.paths.get(user) is None:
+                paths[user] = await conn.discover(user)
+                stopwatch.lap('discover')
+            else:
+                paths[user] = conn.paths[user] = job.paths[user]
+        if job.cached is not None:
+            remote_digest = claviger.worker.combine_digests(
+                        [await conn.digest(user) for user in users])
+            stopwatch.lap('digest')
+            if remote_digest == job.cached.remote_digest:
+                return claviger.worker.cached_result(job)._replace(
+                                                            paths=paths)
+        original_raw_aks = await conn.get_many(users)
+        stopwatch.lap('get')
+        raw_aks, result = claviger.worker.update_authorized_keys(
+                                    job, original_raw_aks, stopwatch)
+        if any(raw_ak is not None for raw_ak in raw_aks):
+            await conn.put_many(users, raw_aks)
+            stopwatch.lap('put')
+    finally:
+        await conn.close()
+        stopwatch.lap('close')
+    return result._replace(paths=paths)
+
+def run_scheduled(func, scheduler, concurrency):
+    """ Runs the coroutine func on the jobs handed out by the
+        claviger.schedule.Scheduler scheduler, with at most concurrency of
+        them at the same time.  Yields the results as they become
+        available.
+
+        Jobs are only taken from the scheduler when there is room for them,
+        so the number of tasks stays bounded however many jobs there are. """
+    loop = asyncio.new_event_loop()
+    # Before Python 3.8 the child watcher for subprocesses is only attached
+    # to the current event loop.
+    asyncio.set_event_loop(loop)
+    pending = {}
+    try:
+        while True:
+            while len(pending) < concurrency:
+                job = scheduler.next()
+                if job is None:
+                    break
+                pending[loop.create_task(func(job))] = job
+            if not pending:
+                break
+            done, _ = loop.run_until_complete(asyncio.wait(pending,
+                                return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                scheduler.done(pending.pop(task))
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -3,9 +3,12 @@ from six.moves import range
 
 import six
 
+import re
 import base64
-import binascii
 import struct
+import hashlib
+import binascii
+import collections
 
 class InvalidLineError(Exception):
     def __init__(self, line, message):
@@ -23,30 +26,49 @@ class CouldNotParseLine(Exception):
     def __init__(self, message):
         self.message = message
 
+# Keytypes are shared between entries using this map.  There are only a
+# few of them, so unlike options or comments, the map stays small.
+_interned = {}
+
+def _intern(s):
+    if s is None:
+        return None
+    return _interned.setdefault(s, s)
+
 class Line(object):
+    __slots__ = ('_raw_line',)
     def __init__(self, raw_line):
         self._raw_line = raw_line
     def store(self, f):
-        f.write(self._raw_line)
+        f.write(self.raw_line)
     @property
     def raw_line(self):
         return self._raw_line
 
 class Comment(Line):
-    pass
+    __slots__ = ()
 
 class InvalidLine(Line):
-    pass
+    __slots__ = ()
 
 class Entry(Line):
+    """ An entry of an authorized_keys file.
+
+        If raw_line is None, the line is rendered from the fields only
+        when it is needed.  Two entries are for the same key if they have
+        the same canonical_key.  It and the fingerprint are computed once,
+        when they are first needed. """
+    __slots__ = ('_options', '_keytype', '_key', '_comment',
+                 '_canonical_key', '_fingerprint')
+
     def __init__(self, options, keytype, key, comment, raw_line=None):
         super(Entry, self).__init__(raw_line)
         self._options = options
-        self._keytype = keytype
+        self._keytype = _intern(keytype)
         self._key = key
         self._comment = comment
-        if raw_line is None:
-            self._update_rawline()
+        self._canonical_key = None
+        self._fingerprint = None
 
     @property
     def options(self):
@@ -55,7 +77,7 @@ class Entry(Line):
     @options.setter
     def options(self, v):
         self._options = v
-        self._update_rawline()
+        self._raw_line = None
 
     @property
     def key(self):
@@ -64,7 +86,26 @@ class Entry(Line):
     @key.setter
     def key(self, v):
         self._key = v
-        self._update_rawline()
+        self._canonical_key = None
+        self._fingerprint = None
+        self._raw_line = None
+
+    @property
+    def blob(self):
+        """ The key, decoded. """
+        return decode_key(self._key)
+
+    @property
+    def canonical_key(self):
+        if self._canonical_key is None:
+            self._canonical_key = canonical_key(self._key)
+        return self._canonical_key
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.canonical_key)
+        return self._fingerprint
 
     @property
     def keytype(self):
@@ -72,8 +113,8 @@ class Entry(Line):
 
     @keytype.setter
     def keytype(self, v):
-        self._keytype = v
-        self._update_rawline()
+        self._keytype = _intern(v)
+        self._raw_line = None
 
     @property
     def comment(self):
@@ -82,16 +123,35 @@ class Entry(Line):
     @comment.setter
     def comment(self, v):
         self._comment = v
-        self._update_rawline()
+        self._raw_line = None
 
-    def _update_rawline(self):
+    @property
+    def raw_line(self):
+        if self._raw_line is not None:
+            return self._raw_line
+        return self._render()
+
+    def _render(self):
         ret = b''
         if self._options:
             ret += self._options + b' '
         ret += self._keytype + b' ' + self._key
         if self._comment:
             ret += b' ' + self._comment
-        self._raw_line = ret
+        return ret
+
+    @staticmethod
+    def _parsed(options, keytype, key, comment, raw_line):
+        # Only keep raw_line around if we cannot render it from the fields.
+        # The fields occur in raw_line in this order, so that is the case
+        # if there is nothing but a single space between them.
+        length = len(keytype) + 1 + len(key)
+        if options:
+            length += len(options) + 1
+        if comment:
+            length += 1 + len(comment)
+        return Entry(options, keytype, key, comment,
+                     None if len(raw_line) == length else raw_line)
 
     @staticmethod
     def parse(raw_line):
@@ -102,27 +162,14 @@ class Entry(Line):
         if isinstance(raw_line, six.text_type):
             raw_line = raw_line.encode('utf-8')
         l = raw_line.strip()
-        in_quote = False
-        after_slash = False
-        i = 0
-        while i < len(l):
-            cur = l[i:i+1] # In Python3 l[i] is an int
-            if cur == b' ' and not in_quote:
-                break
-            if cur == b'"' and not after_slash:
-                in_quote = not in_quote
-            elif cur == b'\\':
-                after_slash = True
-            else:
-                after_slash = False
-            i += 1
+        i = _end_of_first_field(l)
         first_field, rest = l[:i], l[i:].strip()
         # Now the hard part: how to distinguish between options and keytype.
         # The trick: key actually also encodes keytype.
         # First case: first_field is keytype
-        if check_key(rest.split(b' ')[0], first_field):
+        if check_key(rest.split(b' ', 1)[0], first_field):
             bits = rest.split(b' ', 1)
-            return Entry(keytype=first_field,
+            return Entry._parsed(keytype=first_field,
                          key=bits[0],
                          options=None,
                          comment=(None if len(bits) == 1 else bits[1].strip()),
@@ -136,16 +183,45 @@ class Entry(Line):
         key = last_fields[0]
         if not check_key(key, keytype):
             raise CouldNotParseLine("key field is malformed")
-        return Entry(options=first_field,
+        return Entry._parsed(options=first_field,
                      key=key,
                      keytype=keytype,
                      comment=(None if len(last_fields) == 1
                                  else last_fields[1].strip()),
                      raw_line=raw_line)
 
+# Matches a space or a quote
+_SPACE_OR_QUOTE = re.compile(b'[ "]')
+
+def _end_of_first_field(l):
+    """ Returns the position of the first space in l, that is not within
+        quotes.  A quote preceded by a backslash does not count. """
+    in_quote = False
+    i = 0
+    while True:
+        if in_quote:
+            j = l.find(b'"', i)
+        else:
+            m = _SPACE_OR_QUOTE.search(l, i)
+            j = -1 if m is None else m.start()
+        if j == -1:
+            return len(l)
+        if l[j:j+1] == b' ':
+            return j
+        if l[j-1:j] != b'\\':
+            in_quote = not in_quote
+        i = j + 1
+
+# Matches base64 without superfluous characters or padding
+_CANONICAL_B64 = re.compile(br'^[A-Za-z0-9+/]*={0,2}\Z')
+
 def check_key(b64key, keytype):
     """ Check whether key seems to be a valid base64-encoded string
         with the given keytype. """
+    if len(b64key) % 4 == 0 and _CANONICAL_B64.match(b64key):
+        # As the whole string can be decoded, we only have to decode the
+        # quads containing the length and keytype header.
+        b64key = b64key[:4 * ((len(keytype) + 6) // 3)]
     try:
         key = base64.b64decode(b64key)
     except (TypeError, binascii.Error):
@@ -158,36 +234,111 @@ def check_key(b64key, keytype):
     if not key[4:].startswith(keytype):
         return False
     return True
+
+def decode_key(b64key):
+    """ Returns what the base64-encoded key encodes, or None if it cannot
+        be decoded.  Like ssh, we are lenient about padding and the unused
+        bits of the last character, but not about other characters:
+        b64decode would skip those. """
+    b64key += b'=' * (-len(b64key) % 4)
+    if not _CANONICAL_B64.match(b64key):
+        return None
+    try:
+        return base64.b64decode(b64key)
+    except (TypeError, binascii.Error):
+        return None
+
+# The last characters before padding of base64, of which the unused
+# bits are zero.
+_ZERO_LOW_4_BITS = b'AQgw'
+_ZERO_LOW_2_BITS = b'AEIMQUYcgkosw048'
+
+def canonical_key(b64key):
+    """ Returns the canonical base64 encoding of the base64-encoded key.
+        Keys are identified by their canonical encoding: keys that are
+        encoded differently, but decode to the same, have the same
+        canonical encoding.  Almost every key is in canonical encoding
+        already, in which case it is returned as is. """
+    if len(b64key) % 4 == 0 and _CANONICAL_B64.match(b64key):
+        if b64key.endswith(b'=='):
+            if b64key[-3:-2] in _ZERO_LOW_4_BITS:
+                return b64key
+        elif b64key.endswith(b'='):
+            if b64key[-2:-1] in _ZERO_LOW_2_BITS:
+                return b64key
+        else:
+            return b64key
+    blob = decode_key(b64key)
+    if blob is None:
+        return b64key
+    return base64.b64encode(blob)
+
+def fingerprint(b64key):
+    """ Returns the SHA256 fingerprint of the base64-encoded key, as shown
+        by ssh-keygen -l. """
+    blob = decode_key(b64key)
+    if blob is None:
+        blob = b64key
+    return 'SHA256:' + base64.b64encode(hashlib.sha256(blob).digest()
+                                            ).decode('ascii').rstrip('=')
     
 class AuthorizedKeysFile(object):
+    """ A parsed authorized_keys file.
+
+        An index from the canonical keys to the positions of the
+        entries with that key is kept, which is rebuilt whenever lines is
+        assigned.  Thus do not change the key of an Entry after it has been
+        added.  Methods that take a key accept any encoding of it.
+
+        Removed entries are replaced by None, such that the positions of
+        the others stay the same, until lines is read. """
     def __init__(self, lines):
         self.lines = lines
+    @property
+    def lines(self):
+        if self._n_removed:
+            self.lines = [line for line in self._lines if line is not None]
+        return self._lines
+    @lines.setter
+    def lines(self, v):
+        self._lines = v
+        self._n_removed = 0
+        self._index = {}
+        for i, line in enumerate(v):
+            if isinstance(line, Entry):
+                self._index.setdefault(line.canonical_key, []).append(i)
     def get(self, key):
         """ Returns the first occurance of key """
-        for line in self.lines:
-            if not isinstance(line, Entry):
-                continue
-            if line.key == key:
-                return key
+        positions = self._index.get(canonical_key(key))
+        if not positions:
+            return None
+        return self._lines[positions[0]]
     def contains(self, key):
         """ Checks whether a key occurs """
-        for line in self.lines:
-            if not isinstance(line, Entry):
-                continue
-            if line.key == key:
-                return True
-        return False
+        return canonical_key(key) in self._index
     def remove(self, key):
         """ Removes all occurances of the given key. """
-        self.lines = [line for line in self.lines
-                        if not isinstance(line, Entry) or
-                                line.key != key]
+        return self.remove_many((key,))
+    def remove_many(self, keys):
+        """ Removes all occurances of the given keys.
+
+            Returns the number of lines removed. """
+        n_removed = 0
+        for key in keys:
+            for i in self._index.pop(canonical_key(key), ()):
+                self._lines[i] = None
+                n_removed += 1
+        self._n_removed += n_removed
+        return n_removed
     def removeAllKeys(self):
         """ Remove all keys, but leave the other entries. """
-        self.lines = [line for line in self.lines
-                        if not isinstance(line, Entry)]
+        self.lines = [line for line in self._lines
+                        if line is not None and not isinstance(line, Entry)]
     def add(self, options, keytype, key, comment):
-        self.lines.append(Entry(options, keytype, key, comment))
+        entry = Entry(options, keytype, key, comment)
+        self._index.setdefault(entry.canonical_key, []).append(
+                                                        len(self._lines))
+        self._lines.append(entry)
     @property
     def entries(self):
         """ Returns a list of all entries """
@@ -203,6 +354,73 @@ class AuthorizedKeysFile(object):
         return f.getvalue()
     __str__ = __bytes__
 
+# What an authorized_keys file should look like: present is a tuple of
+# Entry with distinct keys, absent and allowed are frozensets of canonical
+# keys.  The keys of present are allowed as well.  names maps canonical
+# keys to the names by which the keys are known, for reporting.  Policies
+# are not changed after they are made, so that they can be shared between
+# servers.
+Policy = collections.namedtuple('Policy',
+                    ('present', 'absent', 'allowed', 'keepOtherKeys',
+                     'names'))
+
+def make_policy(present, absent=(), allow=(), keepOtherKeys=True,
+                names=None):
+    """ Returns the Policy for the arguments of reconcile and names, which
+        maps keys to their names. """
+    unique_present = []
+    seen = set()
+    for entry in present:
+        if entry.canonical_key in seen:
+            continue
+        seen.add(entry.canonical_key)
+        unique_present.append(entry)
+    seen.update(canonical_key(key) for key in allow)
+    return Policy(present=tuple(unique_present),
+                  absent=frozenset(canonical_key(key) for key in absent),
+                  allowed=frozenset(seen), keepOtherKeys=keepOtherKeys,
+                  names={canonical_key(key): name for key, name
+                            in six.iteritems(names)} if names else {})
+
+# Returned by reconcile
+Reconciliation = collections.namedtuple('Reconciliation',
+                    ('added', 'removed', 'ignored', 'result'))
+
+def reconcile(ak, present, absent=(), allow=(), keepOtherKeys=True):
+    """ Computes in one pass how to change the AuthorizedKeysFile ak,
+        such that the entries in present are in it and the keys in absent
+        are not.  If keepOtherKeys is false, all keys that are not in
+        present or allow are removed as well.
+
+        present is a sequence of Entry; absent and allow are collections
+        of keys.  Returns a Reconciliation with the lists of added, removed
+        and ignored (that is: unknown, but kept) entries and the resulting
+        AuthorizedKeysFile.  ak itself is left untouched. """
+    return enforce(ak, make_policy(present, absent, allow, keepOtherKeys))
+
+def enforce(ak, policy):
+    """ Like reconcile, but with the Policy policy. """
+    allowed = policy.allowed
+    absent = policy.absent
+    lines = []
+    removed = []
+    ignored = []
+    for line in ak.lines:
+        if isinstance(line, Entry) and line.canonical_key not in allowed:
+            if not policy.keepOtherKeys or line.canonical_key in absent:
+                removed.append(line)
+                continue
+            ignored.append(line)
+        lines.append(line)
+    added = []
+    for entry in policy.present:
+        if ak.contains(entry.canonical_key):
+            continue
+        added.append(entry)
+        lines.append(entry)
+    return Reconciliation(added=added, removed=removed, ignored=ignored,
+                          result=AuthorizedKeysFile(lines))
+
 def parse(file_or_str, ignoreInvalidLines=True):
     """ Parse authorized_keys from file-like-object or string f.
         
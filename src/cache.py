@@ -0,0 +1,140 @@
+""" Keeps state between runs in claviger's cache directory. """
+import os
+import json
+import logging
+import os.path
+import tempfile
+
+l = logging.getLogger(__name__)
+
+def cache_dir():
+    """ Returns the directory in which claviger keeps its caches. """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'claviger')
+
+def write_atomically(path, data):
+    """ Writes data to path, such that readers either see the old or
+        the new contents. """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or os.curdir,
+                        prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def failed_servers_path():
+    return os.path.join(cache_dir(), 'failed.json')
+
+def load_failed_servers():
+    """ Returns the names of the servers that could not be checked in the
+        previous run, or None if that is not known. """
+    path = failed_servers_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError as e:
+        l.warning('ignoring corrupt %s: %s', path, e)
+        return None
+
+def save_failed_servers(server_names):
+    """ Records the servers that could not be checked in this run, for
+        the next run with --retry-failed. """
+    write_atomically(failed_servers_path(),
+                     json.dumps(sorted(server_names)).encode('utf-8'))
+
+def update_failed_servers(checked, failed):
+    """ Updates the record of failed servers after a run that checked the
+        servers in checked, of which those in failed failed.  Failures of
+        servers that were not checked in this run are kept. """
+    previous = load_failed_servers() or ()
+    checked = frozenset(checked)
+    save_failed_servers(set(server_name for server_name in previous
+                                if server_name not in checked)
+                            | set(failed))
+
+class StateCache(object):
+    """ Remembers for every server the digest of its resolved configuration
+        (see claviger.config.server_digest) and the digest of its
+        authorized_keys file, as it was when the server was last found
+        or made to be in order.
+
+        If neither changed, the server does not have to be checked
+        again.
+
+        It also remembers where the authorized_keys file of a user on a
+        server is, such that it does not have to be looked up every run. """
+    VERSION = 2
+
+    def __init__(self, path=None):
+        self.path = (path if path is not None
+                        else os.path.join(cache_dir(), 'state.json'))
+        self.servers = {}
+        self.paths = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError as e:
+            l.warning('ignoring corrupt cache %s: %s', self.path, e)
+            return
+        if data.get('version') != self.VERSION:
+            return
+        self.servers = data['servers']
+        self.paths = data['paths']
+
+    def get(self, server_name, config_digest):
+        """ Returns the cached entry for the server, if its configuration
+            did not change.  Otherwise returns None. """
+        entry = self.servers.get(server_name)
+        if entry is None or entry['config'] != config_digest:
+            return None
+        return entry
+
+    def update(self, server_name, config_digest, remote_digest,
+                    n_keys_ignored):
+        self.servers[server_name] = {'config': config_digest,
+                                     'remote': remote_digest,
+                                     'ignored': n_keys_ignored}
+        self.changed = True
+
+    def forget(self, server_name):
+        if self.servers.pop(server_name, None) is not None:
+            self.changed = True
+
+    def get_path(self, hostname, port, user):
+        """ Returns the path of the authorized_keys file of user on the
+            server, if known. """
+        return self.paths.get(_path_key(hostname, port, user))
+
+    def set_path(self, hostname, port, user, path):
+        key = _path_key(hostname, port, user)
+        if path is None:
+            if self.paths.pop(key, None) is not None:
+                self.changed = True
+        elif self.paths.get(key) != path:
+            self.paths[key] = path
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        write_atomically(self.path, json.dumps({'version': self.VERSION,
+                            'servers': self.servers,
+                            'paths': self.paths}).encode('utf-8'))
+        self.changed = False
+
+def _path_key(hostname, port, user):
+    return '{0}@{1}:{2}'.format(user, hostname, port)
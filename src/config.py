@@ -1,16 +1,25 @@
-""" Reads claviger's configuration file. """
-import yaml
+""" Reads claviger's configuration file.
+
+    PyYAML, jsonschema and tarjan are only imported when the configuration
+    file has to be processed, which is not the case if the processed
+    configuration is in the cache. """
+import sys
+import json
+import pickle
 import logging
 import os.path
+import fnmatch
+import hashlib
 import textwrap
 import itertools
 import collections
 
 import six
-import tarjan
-import jsonschema
 
 import claviger.authorized_keys
+import claviger.cache
+import claviger.schema
+import claviger.timing
 
 class ConfigError(Exception):
     pass
@@ -20,18 +29,22 @@ ParsedServerKey = collections.namedtuple('ParsedServerKey',
 
 l = logging.getLogger(__name__)
 
-# Schema for the configuration file.
-_SCHEMA = None
+# Bump whenever the structure returned by load() changes, to invalidate
+# the cached processed configurations.
+_COMPILED_VERSION = (4, sys.version_info[0])
+
+# Bump whenever server_digest changes, to invalidate written snapshots.
+_SNAPSHOT_VERSION = 2
 
 def get_schema():
-    global _SCHEMA
-    if not _SCHEMA:
-        l.debug('loading scheme ...')
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                'config.schema.yml')) as f:
-            _SCHEMA = yaml.load(f)
-        l.debug('    ... done!')
-    return _SCHEMA
+    """ Returns the JSON schema of the configuration file. """
+    return claviger.schema.SCHEMA
+
+def _yaml_loader():
+    """ Returns the fastest safe YAML loader: the one of libyaml, if
+        PyYAML was built with it. """
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 class ConfigurationError(Exception):
     pass
@@ -55,15 +68,233 @@ def parse_server_key(key):
     return ParsedServerKey(user=user, port=port, hostname=hostname,
                                 abstract=abstract)
 
-def load(path):
+def server_digest(server, keys):
+    """ Returns a digest of everything in the resolved server stanza that
+        affects the outcome of checking the server, including the key
+        material of the keys it refers to. """
+    h = hashlib.sha256()
+    h.update(repr(tuple(server[attr] for attr in ('hostname', 'port',
+                'users', 'ssh_user', 'keepOtherKeys', 'present', 'absent',
+                'allow'))).encode('utf-8'))
+    for key_name in itertools.chain(server['present'], server['absent'],
+                                    server['allow']):
+        key = keys[key_name]
+        h.update(repr(tuple(key[attr] for attr in ('options', 'keytype',
+                'key', 'comment'))).encode('utf-8'))
+    return h.hexdigest()
+
+def load_snapshot(path):
+    """ Reads a snapshot written by write_snapshot: a map from the names of
+        servers to the server_digest of their resolved stanza.  Returns None
+        if there is no (usable) snapshot. """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except ValueError as e:
+        l.warning('ignoring corrupt snapshot %s: %s', path, e)
+        return None
+    if data.get('version') != _SNAPSHOT_VERSION:
+        l.warning('ignoring snapshot %s of another version', path)
+        return None
+    return data['servers']
+
+def write_snapshot(path, snapshot):
+    claviger.cache.write_atomically(path, json.dumps({
+                        'version': _SNAPSHOT_VERSION,
+                        'servers': snapshot}, sort_keys=True,
+                            indent=1).encode('utf-8'))
+
+def load(path, use_cache=True, stopwatch=None, patterns=None):
     """ Loads the configuration file.
-    
-        A lot of the work is done by YAML.  We validate the easy bits with
-        a JSON schema. The rest by hand. """
-    # TODO Cache schema and configuration file
+
+        If use_cache is set, the processed configuration is stored in
+        claviger's cache directory and reused as long as the contents of
+        the configuration file do not change.  The time spent is recorded
+        on stopwatch, if given.
+
+        If patterns is given, only the servers that match one of them (see
+        matches) have to be in the returned configuration.  If there is no
+        processed configuration in the cache, only those servers are
+        processed. """
+    if stopwatch is None:
+        stopwatch = claviger.timing.Stopwatch()
     l.debug('loading configuration file ...')
-    with open(path) as f:
-        cfg = yaml.load(f)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    stopwatch.lap('read')
+    if not use_cache:
+        return parse(raw, stopwatch, patterns)
+    digest = hashlib.sha256(raw).hexdigest()
+    cache_path = os.path.join(claviger.cache.cache_dir(), 'config-{0}.pickle'
+                    .format(hashlib.sha256(os.path.realpath(path)
+                                .encode('utf-8')).hexdigest()[:16]))
+    cfg = _load_compiled(cache_path, digest)
+    stopwatch.lap('cache')
+    if cfg is not None:
+        l.debug('         ... found in cache')
+        return cfg
+    if patterns is not None:
+        # We do not cache a partially processed configuration.
+        return parse(raw, stopwatch, patterns)
+    cfg = parse(raw, stopwatch)
+    try:
+        claviger.cache.write_atomically(cache_path,
+                    pickle.dumps((_COMPILED_VERSION, digest),
+                                 pickle.HIGHEST_PROTOCOL) +
+                    pickle.dumps(cfg, pickle.HIGHEST_PROTOCOL))
+    except (OSError, IOError) as e:
+        l.warning('could not cache configuration in %s: %s', cache_path, e)
+    stopwatch.lap('store cache')
+    return cfg
+
+def _load_compiled(cache_path, digest):
+    """ Returns the processed configuration stored in cache_path, if it
+        was created from a configuration file with the given digest. """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            # The header is stored separately, such that we do not have
+            # to unpickle the configuration if it is stale.
+            if pickle.load(f) != (_COMPILED_VERSION, digest):
+                return None
+            return pickle.load(f)
+    except Exception as e:
+        l.warning('ignoring corrupt cache %s: %s', cache_path, e)
+        return None
+
+def resolve_inheritance(servers):
+    """ Fills in the attributes of the server stanzas in servers, a map
+        from server names to stanzas, from the stanzas they are `like'. """
+    # create dependancy graph and use Tarjan's algorithm to find a possible
+    # order to evaluate the server stanzas.  As the stanza a server is like
+    # comes first, it is resolved already when we get to the server.
+    server_dg = {server_name: [server['like']] if server['like'] else []
+                    for server_name, server in six.iteritems(servers)}
+    # Maps the names of resolved stanzas that are inherited from to their
+    # present, absent and allow lists without duplicates.
+    key_lists = {}
+    import tarjan
+    for server_cycle_names in tarjan.tarjan(server_dg):
+        if len(server_cycle_names) != 1:
+            raise ConfigurationError(
+                    "There is a cyclic dependacy among the servers {0}".format(
+                                server_cycle_names))
+        target_server = servers[server_cycle_names[0]]
+        if not target_server['like']:
+            continue
+        if not target_server['like'] in servers:
+            pass
+        source_name = target_server['like']
+        source_server = servers[source_name]
+        if source_name not in key_lists:
+            key_lists[source_name] = tuple(_unique(source_server[attr])
+                            for attr in ('present', 'absent', 'allow'))
+        _inherit(target_server, source_server, *key_lists[source_name])
+
+def _select(cfg, patterns):
+    """ Removes from the unprocessed configuration cfg the servers that do
+        not match patterns, except for the stanzas they are like, and the
+        keys that are not referred to by the remaining servers. """
+    # Maps the names of the stanzas to their keys
+    stanza_keys = {}
+    for server_key, server in six.iteritems(cfg['servers']):
+        name = (server.get('name', server_key)
+                    if isinstance(server, dict) else server_key)
+        stanza_keys[name] = server_key
+    todo = [server_key for name, server_key in six.iteritems(stanza_keys)
+                if not parse_server_key(server_key).abstract
+                    and matches(name, patterns)]
+    selected = set(todo)
+    while todo:
+        server_key = todo.pop()
+        server = cfg['servers'][server_key]
+        if not isinstance(server, dict):
+            continue
+        like = server.get('like', '$default' if server_key != '$default'
+                                        else None)
+        if not isinstance(like, six.string_types):
+            continue
+        server_key = stanza_keys.get(like)
+        if server_key is not None and server_key not in selected:
+            selected.add(server_key)
+            todo.append(server_key)
+    cfg['servers'] = {server_key: cfg['servers'][server_key]
+                        for server_key in selected}
+    if not isinstance(cfg.get('keys'), dict):
+        return
+    referred = set()
+    for server in six.itervalues(cfg['servers']):
+        if not isinstance(server, dict):
+            continue
+        for attr in ('present', 'absent', 'allow'):
+            if isinstance(server.get(attr), list):
+                referred.update(key_name for key_name in server[attr]
+                                    if isinstance(key_name, six.string_types))
+    cfg['keys'] = {key_name: key
+                    for key_name, key in six.iteritems(cfg['keys'])
+                    if key_name in referred}
+
+def _unique(xs):
+    """ Returns xs without duplicates, preserving order. """
+    seen = set()
+    ret = []
+    for x in xs:
+        if x not in seen:
+            seen.add(x)
+            ret.append(x)
+    return ret
+
+def _inherit(target_server, source_server, present, absent, allow):
+    """ Fills in the attributes of target_server from source_server, which
+        has the given present, absent and allow lists without
+        duplicates. """
+    # First the simple attributes
+    for attr in ('port', 'user', 'hostname', 'ssh_user',
+                    'keepOtherKeys', 'group', 'groupConnections'):
+        if attr in source_server:
+            if target_server[attr] is None:
+                target_server[attr] = source_server[attr]
+
+    # Now, the present/absent/allow lists.  As no stanza may have keys
+    # that are both present and absent or both allowed and absent, the
+    # absent list of the resolved source_server is disjoint from its other
+    # lists.  Thus we only have to check the keys against the own lists
+    # of target_server.
+    own_present = frozenset(target_server['present'])
+    own_absent = frozenset(target_server['absent'])
+    own_allow = frozenset(target_server['allow'])
+    for attr, keys, excluded in (
+            ('present', present, own_present | own_absent),
+            ('absent', absent, own_present | own_absent | own_allow),
+            ('allow', allow, own_absent | own_allow)):
+        if excluded:
+            keys = [key for key in keys if key not in excluded]
+        target_server[attr].extend(keys)
+
+def matches(server_name, patterns):
+    """ Checks whether server_name matches one of the shell-style wildcard
+        patterns (like `web*'). """
+    return any(fnmatch.fnmatchcase(server_name, pattern)
+                    for pattern in patterns)
+
+def parse(raw, stopwatch=None, patterns=None):
+    """ Processes the contents of a configuration file.
+
+        A lot of the work is done by YAML.  We validate the easy bits with
+        a JSON schema. The rest by hand.
+
+        If patterns is given, only the servers matching them, the stanzas
+        they are like and the keys these refer to are processed. """
+    import yaml
+    import jsonschema
+    if stopwatch is None:
+        stopwatch = claviger.timing.Stopwatch()
+    stopwatch.lap('import')
+    cfg = yaml.load(raw, Loader=_yaml_loader())
+    stopwatch.lap('yaml')
 
     if not isinstance(cfg, dict):
         raise ConfigurationError('Configuration file is empty')
@@ -76,23 +307,38 @@ def load(path):
         if cfg['servers'][key] is None:
             cfg['servers'][key] = dict()
 
+    if patterns is not None:
+        _select(cfg, patterns)
+        stopwatch.lap('select')
+
     # Now check the schema
     jsonschema.validate(cfg, get_schema())
     # TODO format into pretty error message
 
+    stopwatch.lap('schema')
+
     l.debug('  - processing keys')
     new_keys = {}
+    # Maps fingerprints to the name of the key
+    key_names = {}
     cfg.setdefault('keys', {})
-    for key_name, key in six.iteritems(cfg['keys']):
+    for key_name, key in sorted(six.iteritems(cfg['keys'])):
         # TODO handle error
         entry = claviger.authorized_keys.Entry.parse(key)
         new_key = {'key': entry.key,
                    'options': entry.options,
                    'comment': entry.comment,
-                   'keytype': entry.keytype}
+                   'keytype': entry.keytype,
+                   'fingerprint': entry.fingerprint}
         new_keys[key_name] = new_key
+        if entry.fingerprint in key_names:
+            l.warning('keys %s and %s are the same key',
+                            key_names[entry.fingerprint], key_name)
+        key_names.setdefault(entry.fingerprint, key_name)
     cfg['keys'] = new_keys
 
+    stopwatch.lap('keys')
+
     l.debug('  - processing server stanza short-hands')
     new_servers = {}
     for server_key, server in six.iteritems(cfg['servers']):
@@ -102,11 +348,16 @@ def load(path):
         server.setdefault('port', parsed_server_key.port)
         server.setdefault('user', parsed_server_key.user)
         server.setdefault('hostname', parsed_server_key.hostname)
-        server.setdefault('ssh_user', server['user'])
+        if isinstance(server['user'], list):
+            server.setdefault('ssh_user', server['user'][0])
+        else:
+            server.setdefault('ssh_user', server['user'])
         server.setdefault('present', [])
         server.setdefault('absent', [])
         server.setdefault('allow', [])
         server.setdefault('keepOtherKeys')
+        server.setdefault('group')
+        server.setdefault('groupConnections')
         server.setdefault('like', '$default' if server_key != '$default'
                                         else None)
         server.setdefault('abstract', parsed_server_key.abstract)
@@ -130,47 +381,12 @@ def load(path):
         new_servers[server_name] = server
     cfg['servers'] = new_servers
 
+    stopwatch.lap('servers')
+
     l.debug('  - resolving server stanza inheritance')
-    # create dependancy graph and use Tarjan's algorithm to find a possible
-    # order to evaluate the server stanzas.
-    server_dg = {server_name: [server['like']] if server['like'] else []
-                    for server_name, server in six.iteritems(cfg['servers'])}
-    for server_cycle_names in tarjan.tarjan(server_dg):
-        if len(server_cycle_names) != 1:
-            raise ConfigurationError(
-                    "There is a cyclic dependacy among the servers {0}".format(
-                                server_cycle_names))
-        target_server = cfg['servers'][server_cycle_names[0]]
-        if not target_server['like']:
-            continue
-        if not target_server['like'] in cfg['servers']:
-            pass
-        source_server = cfg['servers'][target_server['like']]
-
-        # First the simple attributes
-        for attr in ('port', 'user', 'hostname', 'ssh_user',
-                        'keepOtherKeys'):
-            if attr in source_server:
-                if target_server[attr] is None:
-                    target_server[attr] = source_server[attr]
-
-        # Now, the present/absent/allow lists
-        for key in source_server['present']:
-            if key in target_server['absent']:
-                continue
-            if key not in target_server['present']:
-                target_server['present'].append(key)
-        for key in source_server['absent']:
-            if (key in target_server['present']
-                    or key in target_server['allow']):
-                continue
-            if key not in target_server['absent']:
-                target_server['absent'].append(key)
-        for key in source_server['allow']:
-            if key in target_server['absent']:
-                continue
-            if key not in target_server['allow']:
-                target_server['allow'].append(key)
+    resolve_inheritance(cfg['servers'])
+
+    stopwatch.lap('inheritance')
 
     l.debug('  - setting defaults on server stanzas')
     for server in six.itervalues(cfg['servers']):
@@ -179,7 +395,17 @@ def load(path):
                            ('keepOtherKeys', True)):
             if server[attr] is None:
                 server[attr] = dflt
-        
+        # user is either a single user or a list of users to manage.  We
+        # put the list in users and the first (or only) user in user.
+        if isinstance(server['user'], list):
+            server['users'] = server['user']
+            server['user'] = server['users'][0]
+        else:
+            server['users'] = [server['user']]
+        if server['ssh_user'] is None:
+            server['ssh_user'] = server['user']
+
+    stopwatch.lap('defaults')
     l.debug('         ... done')
 
     return cfg
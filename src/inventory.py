@@ -0,0 +1,97 @@
+""" Keeps an inventory of the keys found on the servers.
+
+    With --inventory, every authorized_keys file that is fetched is recorded
+    in a SQLite database, indexed by the fingerprints of the keys.  Then
+    --find-key answers which servers have a key without contacting them. """
+import os
+import time
+import logging
+import os.path
+import sqlite3
+
+import claviger.cache
+
+l = logging.getLogger(__name__)
+
+# keys has a row for every entry of the recorded authorized_keys files.
+_SCHEMA = """
+CREATE TABLE servers (
+    server TEXT PRIMARY KEY,
+    digest TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE keys (
+    server TEXT NOT NULL,
+    user TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    keytype TEXT NOT NULL,
+    comment TEXT,
+    options TEXT
+);
+CREATE INDEX keys_fingerprint ON keys (fingerprint);
+CREATE INDEX keys_server ON keys (server);
+"""
+
+def default_path():
+    return os.path.join(claviger.cache.cache_dir(), 'inventory.sqlite')
+
+class Inventory(object):
+    """ The inventory at path.  Changes are made in a single transaction,
+        which is committed by close(). """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_path()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.VERSION:
+            if version:
+                l.warning('rebuilding inventory %s of an older version',
+                                self.path)
+            for table in ('servers', 'keys'):
+                self.db.execute('DROP TABLE IF EXISTS {0}'.format(table))
+            self.db.executescript(_SCHEMA)
+            self.db.execute('PRAGMA user_version = {0}'.format(self.VERSION))
+
+    def digest(self, server_name):
+        """ Returns the digest of the authorized_keys file(s) of the server
+            (see claviger.worker.JobResult) when it was last recorded, or
+            None if it is not known. """
+        row = self.db.execute('SELECT digest FROM servers WHERE server = ?',
+                              (server_name,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, server_name, digest, entries):
+        """ Replaces what is known about the server by the list of entries,
+            which are tuples (user, fingerprint, keytype, comment,
+            options). """
+        self.db.execute('DELETE FROM keys WHERE server = ?', (server_name,))
+        self.db.executemany('INSERT INTO keys VALUES (?, ?, ?, ?, ?, ?)',
+                            [(server_name,) + tuple(entry)
+                                for entry in entries])
+        self.db.execute('INSERT OR REPLACE INTO servers VALUES (?, ?, ?)',
+                        (server_name, digest, time.time()))
+
+    def prune(self, server_names):
+        """ Forgets the servers that are not in server_names. """
+        keep = frozenset(server_names)
+        doomed = [(server_name,) for server_name, in
+                    self.db.execute('SELECT server FROM servers')
+                        if server_name not in keep]
+        self.db.executemany('DELETE FROM keys WHERE server = ?', doomed)
+        self.db.executemany('DELETE FROM servers WHERE server = ?', doomed)
+
+    def find(self, fingerprint):
+        """ Returns the list of (server, user, comment) that have the key
+            with the given fingerprint. """
+        return self.db.execute('SELECT server, user, comment FROM keys '
+                               'WHERE fingerprint = ? '
+                               'ORDER BY server, user',
+                               (fingerprint,)).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
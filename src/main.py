@@ -1,31 +1,47 @@
-import demandimport
-demandimport.enable()
-
-import multiprocessing.dummy
+import functools
 import itertools
 import traceback
 import argparse
 import textwrap
 import os.path
 import logging
+import json
 import sys
 import os
 
 import claviger.authorized_keys
 import claviger.config
+import claviger.cache
+import claviger.report
+import claviger.schedule
+import claviger.timing
 import claviger.worker
 import claviger.scp
 
 import six
-import yaml
 
 l = logging.getLogger(__name__)
 
+# Modules that are slow to import (or, in case of claviger.aio, require
+# Python 3.5) are imported when they are needed.  This keeps short runs,
+# like those from cron on a cached configuration, short.
+
+def load_aio():
+    import claviger.aio
+    return claviger.aio
+
+def load_inventory():
+    import claviger.inventory
+    return claviger.inventory
+
 class Claviger(object):
     """ main object for claviger """
+    def __init__(self):
+        self.profile = claviger.timing.Profile()
+
     def main(self, args):
         try:
-            self.parse_commandline_args()
+            self.parse_commandline_args(args)
 
             extra_logging_config = {}
             if self.args.verbosity >= 2:
@@ -38,10 +54,18 @@ class Claviger(object):
                 level = logging.WARNING
             logging.basicConfig(level=level, **extra_logging_config)
 
+            if self.args.find_key is not None:
+                return self.find_key()
             if not os.path.exists(self.args.configfile):
                 return self.show_configuration_instructions()
-            self.cfg = claviger.config.load(self.args.configfile)
+            stopwatch = claviger.timing.Stopwatch()
+            self.cfg = claviger.config.load(self.args.configfile,
+                                            use_cache=not self.args.no_cache,
+                                            stopwatch=stopwatch,
+                                            patterns=self.args.servers or None)
+            self.profile.config_timings = stopwatch.timings
             self.check_servers()
+            self.write_profile()
         except claviger.config.ConfigurationError as e:
             s = 'There was a problem with your configfile {0}:\n {1}\n'
             sys.stderr.write(s.format(self.args.configfile, e))
@@ -50,56 +74,254 @@ class Claviger(object):
             return self.handle_uncaught_exception()
 
     def check_servers(self):
-        if self.args.parallel_connections == 1:
-            # If we want one worker, the current thread will do just fine.
-            the_map = itertools.imap
+        # With several processes, every process creates its own SCP.
+        scp = create_scp(self.args) if self.args.processes == 1 else None
+        self.state_cache = (None if self.args.no_cache
+                                else claviger.cache.StateCache())
+        self.inventory = None
+        if self.args.inventory:
+            self.inventory = load_inventory().Inventory(
+                                    self.args.inventory_file)
+        try:
+            self._check_servers(scp)
+        finally:
+            if scp is not None:
+                scp.close()
+            if self.inventory is not None:
+                self.inventory.close()
+            if self.state_cache is not None:
+                self.state_cache.save()
+
+    def _create_job(self, server_name):
+        server = self.cfg['servers'][server_name]
+        cached = None
+        paths = {}
+        if self.state_cache is not None and not self.args.refresh:
+            for user in server['users']:
+                paths[user] = self.state_cache.get_path(server['hostname'],
+                                                    server['port'], user)
+            config_digest = self._server_digest(server_name)
+            entry = self.state_cache.get(server_name, config_digest)
+            if (entry is not None and not self.args.refresh
+                    and (self.inventory is None
+                            or self.inventory.digest(server_name)
+                                    == entry['remote'])):
+                cached = claviger.worker.CachedState(
+                            remote_digest=entry['remote'],
+                            n_keys_ignored=entry['ignored'])
+        return claviger.worker.Job(server=server,
+                                   policy=self._policy(server),
+                                   dry_run=self.args.dry_run,
+                                   no_diff=(self.args.no_diff
+                                                or self.args.summary),
+                                   cached=cached,
+                                   paths=paths,
+                                   inventory=self.inventory is not None)
+
+    def _policy(self, server):
+        """ Returns the Policy of the resolved stanza server.  Servers with
+            the same key lists (typically because they are like the same
+            stanza) share a single Policy. """
+        policy_key = (tuple(server['present']), tuple(server['absent']),
+                      tuple(server['allow']), server['keepOtherKeys'])
+        policy = self.policies.get(policy_key)
+        if policy is None:
+            keys = self.cfg['keys']
+            policy = self.policies[policy_key] = \
+                    claviger.authorized_keys.make_policy(
+                        present=[self._key_entry(name)
+                                    for name in server['present']],
+                        absent=[keys[name]['key']
+                                    for name in server['absent']],
+                        allow=[keys[name]['key']
+                                    for name in server['allow']],
+                        keepOtherKeys=server['keepOtherKeys'],
+                        names={keys[name]['key']: name
+                                for name in itertools.chain(server['present'],
+                                        server['absent'], server['allow'])})
+        return policy
+
+    def _key_entry(self, key_name):
+        """ Returns the Entry for the key key_name, which is shared between
+            all policies. """
+        entry = self.key_entries.get(key_name)
+        if entry is None:
+            key = self.cfg['keys'][key_name]
+            entry = self.key_entries[key_name] = \
+                    claviger.authorized_keys.Entry(key['options'],
+                                key['keytype'], key['key'], key['comment'])
+        return entry
+
+    def _server_digest(self, server_name):
+        if server_name not in self.server_digests:
+            self.server_digests[server_name] = \
+                    claviger.config.server_digest(
+                        self.cfg['servers'][server_name], self.cfg['keys'])
+        return self.server_digests[server_name]
+
+    def _update_state_cache(self, ret):
+        if self.state_cache is None:
+            return
+        server = self.cfg['servers'][ret.server_name]
+        # If the server is not in order, the paths might be wrong: look
+        # them up again next time, like the server is checked again.
+        in_order = ret.ok and ret.result.remote_digest is not None
+        for user in server['users']:
+            self.state_cache.set_path(server['hostname'], server['port'], user,
+                                      ret.result.paths.get(user)
+                                            if in_order else None)
+        if not in_order:
+            self.state_cache.forget(ret.server_name)
+            return
+        self.state_cache.update(ret.server_name,
+                                self.server_digests[ret.server_name],
+                                ret.result.remote_digest,
+                                ret.result.n_keys_ignored)
+
+    def _servers_to_check(self):
+        server_names = [server_name for server_name in self.cfg['servers']
+                        if not self.cfg['servers'][server_name]['abstract']]
+        if self.args.servers:
+            server_names = [server_name for server_name in server_names
+                    if claviger.config.matches(server_name, self.args.servers)]
+            if not server_names:
+                l.warning('no server matches %s',
+                                ' '.join(self.args.servers))
+        if self.args.retry_failed:
+            failed = claviger.cache.load_failed_servers()
+            if failed is None:
+                l.warning('no record of failed servers: checking all servers')
+            else:
+                failed = frozenset(failed)
+                server_names = [server_name for server_name in server_names
+                                    if server_name in failed]
+        if self.args.changed_since:
+            snapshot = claviger.config.load_snapshot(self.args.changed_since)
+            if snapshot is None:
+                l.warning('no snapshot %s: checking all servers',
+                                self.args.changed_since)
+            else:
+                server_names = [server_name for server_name in server_names
+                                    if snapshot.get(server_name)
+                                        != self._server_digest(server_name)]
+        return server_names
+
+    def _check_servers(self, scp):
+        self.server_digests = {}
+        self.policies = {}
+        self.key_entries = {}
+        jobs = (self._create_job(server_name)
+                    for server_name in self._servers_to_check())
+        if scp is None:
+            results = run_sharded(list(jobs), self.args)
         else:
-            # As check_server is iobound, threads are better than processes.
-            pool = multiprocessing.dummy.Pool(
-                            processes=self.args.parallel_connections)
-            the_map = pool.imap_unordered
-
-        global_changes = False
-        errors_occured = False
-        for ret in the_map(claviger.worker.check_server,
-                (claviger.worker.Job(server=self.cfg['servers'][server_name],
-                                    keys=self.cfg['keys'],
-                                    dry_run=self.args.dry_run,
-                                    no_diff=self.args.no_diff)
-                         for server_name in self.cfg['servers']
-                         if not self.cfg['servers'][server_name]['abstract'])):
-            if not ret.ok:
-                errors_occured = True
-                if isinstance(ret.result,
-                        claviger.scp.HostKeyVerificationFailed):
-                    print("{0:<40} host key verification failed".format(
-                                ret.server_name))
-                else:
-                    print("")
-                    print("{0:<40} error".format(ret.server_name))
-                    print("   {0}".format(ret.result))
-                    print("")
-                continue
-            res = ret.result
-            changes = any([res.n_keys_added, res.n_keys_removed])
-            global_changes |= changes
+            results = run_jobs(jobs, scp, self.args,
+                               self.args.parallel_connections)
+
+        reporter = claviger.report.REPORTERS[self.args.output](
+                            dry_run=self.args.dry_run,
+                            verbosity=self.args.verbosity,
+                            summary=self.args.summary)
+        # The servers that are in order after this run
+        in_order = {}
+        for ret in results:
+            self._update_state_cache(ret)
+            if (self.inventory is not None and ret.ok
+                    and ret.result.entries is not None):
+                self.inventory.record(ret.server_name,
+                                      ret.result.remote_digest,
+                                      ret.result.entries)
+            in_order[ret.server_name] = (ret.ok and
+                                ret.result.remote_digest is not None)
             l.debug('        %s: done', ret.server_name)
-            if not changes and not self.args.verbosity:
-                continue
-            print ("{0:<40} +{1:<2} -{2:<2} ?{3:<2}".format(ret.server_name,
-                            res.n_keys_added, res.n_keys_removed,
-                            res.n_keys_ignored))
-        if not global_changes and not errors_occured:
-            print('Everything is in order.')
-        elif self.args.dry_run and not errors_occured:
-            print('')
-            print("This is a dry run: no changes have been made.")
-            print("Rerun with `-f' to apply changes.")
-        elif errors_occured:
-            print('')
-            print('Checking some servers failed.  See above.')
-            if self.args.dry_run:
-                print("This is a dry run: no changes have been made.")
+            reporter.report(ret)
+            self.profile.add(ret)
+        reporter.finish()
+        if not self.args.no_cache:
+            claviger.cache.update_failed_servers(in_order, reporter.failed)
+        if self.args.write_snapshot:
+            self._write_snapshot(in_order)
+        if self.inventory is not None and not self.args.servers:
+            # Forget the servers that are not in the configuration anymore
+            self.inventory.prune(server_name
+                    for server_name, server in self.cfg['servers'].items()
+                        if not server['abstract'])
+
+    def _write_snapshot(self, in_order):
+        """ Writes the snapshot for --write-snapshot.  It contains the
+            servers that are in order, with the digest of the configuration
+            they are in order with.  Servers that were not checked keep
+            their entry from the previous snapshot. """
+        snapshot = (claviger.config.load_snapshot(self.args.write_snapshot)
+                        or {})
+        # If only some servers were selected, self.cfg might not contain
+        # the others.
+        if not self.args.servers:
+            for server_name in list(snapshot):
+                server = self.cfg['servers'].get(server_name)
+                if server is None or server['abstract']:
+                    del snapshot[server_name]
+        for server_name, ok in in_order.items():
+            if ok:
+                snapshot[server_name] = self._server_digest(server_name)
+            else:
+                snapshot.pop(server_name, None)
+        claviger.config.write_snapshot(self.args.write_snapshot, snapshot)
+
+    def find_key(self):
+        """ Lists the servers on which the inventory found the key given
+            to --find-key. """
+        inventory_module = load_inventory()
+        fingerprint = self._fingerprint(self.args.find_key)
+        if fingerprint is None:
+            sys.stderr.write('{0} is not a key, fingerprint or the name of '
+                             'a key in {1}\n'.format(self.args.find_key,
+                                                     self.args.configfile))
+            return 3
+        path = (self.args.inventory_file
+                    or inventory_module.default_path())
+        if not os.path.exists(path):
+            sys.stderr.write('There is no inventory {0}.  Run claviger with '
+                             '--inventory first.\n'.format(path))
+            return 3
+        inventory = inventory_module.Inventory(path)
+        try:
+            found = inventory.find(fingerprint)
+        finally:
+            inventory.close()
+        for server_name, user, comment in found:
+            if self.args.output == 'json':
+                print(json.dumps({'server': server_name, 'user': user,
+                                  'comment': comment}, sort_keys=True))
+            else:
+                print('{0:<40} {1:<16} {2}'.format(server_name, user,
+                                                   comment or ''))
+        return 0 if found else 1
+
+    def _fingerprint(self, key):
+        """ Returns the fingerprint of key, which is either a fingerprint,
+            a public key or the name of a key in the configuration file. """
+        if key.startswith('SHA256:'):
+            return key
+        try:
+            return claviger.authorized_keys.Entry.parse(key).fingerprint
+        except claviger.authorized_keys.CouldNotParseLine:
+            pass
+        if not os.path.exists(self.args.configfile):
+            return None
+        cfg = claviger.config.load(self.args.configfile,
+                                   use_cache=not self.args.no_cache)
+        if key not in cfg['keys']:
+            return None
+        return cfg['keys'][key]['fingerprint']
+
+    def write_profile(self):
+        if self.args.profile:
+            self.profile.write(sys.stderr, self.args.profile)
+        if self.args.profile_json:
+            with open(self.args.profile_json, 'w') as f:
+                json.dump(self.profile.as_dict(self.args.profile or 10), f,
+                          indent=2)
 
     def find_ssh_pubkeys(self):
         """ Searches for SSH public keys in the user's homedir.
@@ -152,9 +374,12 @@ class Claviger(object):
             print("               - {0}".format(yaml_str(name)))
         return 1
 
-    def parse_commandline_args(self):
+    def parse_commandline_args(self, args=None):
         parser = argparse.ArgumentParser(
                         description='Synchronize remote SSH authorized_keys')
+        parser.add_argument('servers', metavar='SERVER', nargs='*',
+                    help='Only check the servers whose name matches one of '+
+                         'these shell-style wildcards, like web*')
         parser.add_argument('-c', '--configfile', metavar='PATH',
                                 type=os.path.expanduser, default='~/.claviger',
                                 help='Configuration file')
@@ -164,12 +389,83 @@ class Claviger(object):
         parser.add_argument('--parallel-connections', '-p', metavar='N',
                                 type=int, default=8,
                     help='Number of parallel connections')
+        parser.add_argument('--processes', metavar='N', type=int, default=1,
+                    help='Divide the servers over N processes, which each '+
+                         'make their share of the parallel connections')
         parser.add_argument('--apply-changes', '-f', action='store_false',
                             dest='dry_run',
                     help='Apply changes')
         parser.add_argument('--no-diff', '-s', action='store_true',
                     help='Do not show a diff during the dry run')
-        self.args = parser.parse_args()
+        parser.add_argument('--summary', action='store_true',
+                    help='Instead of a diff per server, show every distinct '+
+                         'change once with the servers it applies to')
+        parser.add_argument('--output', '-o', default='text',
+                            choices=sorted(claviger.report.REPORTERS),
+                    help='Report the results in human readable text or '+
+                         'as a line of JSON per server as soon as it is done')
+        parser.add_argument('--profile', metavar='N', type=int, nargs='?',
+                            const=10, default=0,
+                    help='Show where time is spent and the N slowest servers')
+        parser.add_argument('--profile-json', metavar='PATH',
+                    help='Write the timings to PATH as JSON')
+        parser.add_argument('--no-cache', action='store_true',
+                    help='Do not use or update the cached configuration '+
+                         'and state of the servers from previous runs')
+        parser.add_argument('--refresh', action='store_true',
+                    help='Check all servers, even those that did not '+
+                         'change since the previous run, and look up '+
+                         'their authorized_keys files again')
+        parser.add_argument('--engine', default='threads',
+                            choices=('threads', 'asyncio'),
+                    help='Run the connections in a pool of threads or '+
+                         'from a single asyncio event loop')
+        parser.add_argument('--transport', default='scp',
+                            choices=sorted(claviger.scp.TRANSPORTS),
+                    help='How to fetch and write back authorized_keys: '+
+                         'scp uses separate scp calls, ssh uses a single '+
+                         'ssh session per server')
+        parser.add_argument('--connect-timeout', metavar='SECONDS',
+                            type=float, default=10,
+                    help='Give up connecting to a server after this many '+
+                         'seconds.  0 to wait indefinitely')
+        parser.add_argument('--timeout', metavar='SECONDS', type=float,
+                            default=300,
+                    help='Kill every ssh and scp that runs longer than this '+
+                         'many seconds.  0 to wait indefinitely')
+        parser.add_argument('--retries', metavar='N', type=int, default=2,
+                    help='Number of times to retry a server after a '+
+                         'transient failure, like a dropped connection')
+        parser.add_argument('--retry-failed', action='store_true',
+                    help='Only check the servers that failed the '+
+                         'last time they were checked')
+        parser.add_argument('--changed-since', metavar='SNAPSHOT',
+                            type=os.path.expanduser,
+                    help='Only check the servers whose configuration '+
+                         'changed since SNAPSHOT was written')
+        parser.add_argument('--write-snapshot', metavar='SNAPSHOT',
+                            type=os.path.expanduser,
+                    help='Record in SNAPSHOT the configuration of the '+
+                         'servers that are in order, for --changed-since')
+        parser.add_argument('--inventory', action='store_true',
+                    help='Record the keys found on the servers in the '+
+                         'inventory, for --find-key')
+        parser.add_argument('--inventory-file', metavar='PATH',
+                            type=os.path.expanduser,
+                    help='Where to keep the inventory.  By default in '+
+                         '~/.cache/claviger')
+        parser.add_argument('--find-key', metavar='KEY',
+                    help='List the servers that have KEY according to the '+
+                         'inventory, without contacting them.  KEY is a '+
+                         'public key, its SHA256 fingerprint or its name '+
+                         'in the configuration file')
+        self.args = parser.parse_args(args)
+        if self.args.retry_failed and self.args.no_cache:
+            parser.error('--retry-failed requires the cache')
+        if self.args.processes < 1:
+            parser.error('--processes must be at least 1')
+        if self.args.processes > self.args.parallel_connections:
+            parser.error('--processes cannot exceed --parallel-connections')
 
     def handle_uncaught_exception(self):
         sys.stderr.write('\n')
@@ -184,10 +480,100 @@ class Claviger(object):
         sys.stderr.flush()
         return 2
 
+def create_scp(args):
+    """ Returns the SCP for the transport and engine chosen on the
+        commandline. """
+    if args.engine == 'asyncio':
+        transports = load_aio().TRANSPORTS
+    else:
+        transports = claviger.scp.TRANSPORTS
+    # All workers share one SCP, such that the master connection to
+    # a server is reused for both fetching and writing back.
+    return transports[args.transport](
+                connect_timeout=args.connect_timeout or None,
+                timeout=args.timeout or None,
+                retries=args.retries)
+
+def run_jobs(jobs, scp, args, concurrency):
+    """ Checks the servers of jobs using scp and the engine chosen on the
+        commandline, with at most concurrency connections at the same
+        time.  Yields the JobReturns as they become available. """
+    scheduler = claviger.schedule.Scheduler(jobs)
+    if args.engine == 'asyncio':
+        aio = load_aio()
+        return aio.run_scheduled(functools.partial(aio.check_server, scp=scp),
+                                 scheduler, concurrency)
+    check_server = functools.partial(claviger.worker.check_server, scp=scp)
+    if concurrency == 1:
+        # If we want one worker, the current thread will do just fine.
+        return claviger.schedule.run_sequentially(check_server, scheduler)
+    # As check_server is iobound, threads are better than processes.
+    import multiprocessing.dummy
+    pool = multiprocessing.dummy.Pool(processes=concurrency)
+    return claviger.schedule.run_threaded(check_server, scheduler, pool,
+                                          concurrency)
+
+def run_shard(jobs, args, concurrency, results):
+    """ Checks the servers of jobs in a process of its own, like run_jobs.
+        Puts the JobReturns on the queue results, followed by None.  If
+        something unexpected goes wrong, puts an exception instead. """
+    scp = create_scp(args)
+    try:
+        for ret in run_jobs(jobs, scp, args, concurrency):
+            results.put(ret)
+    except Exception:
+        results.put(Exception(traceback.format_exc()))
+    finally:
+        scp.close()
+        results.put(None)
+
+def run_sharded(jobs, args):
+    """ Divides jobs over --processes processes, which each check their
+        share of the servers with their own engine.  The servers of a group
+        are checked by the same process, such that its limit holds.  Yields
+        the JobReturns as they become available. """
+    import multiprocessing
+    shards = [shard for shard in claviger.schedule.shard(jobs,
+                                                args.processes) if shard]
+    # Together, the processes make --parallel-connections connections
+    # at the same time: the first ones make one more than the others if
+    # they cannot be divided evenly.
+    base, extra = divmod(args.parallel_connections, max(1, len(shards)))
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_shard,
+                        args=(shard, args, base + (i < extra), results))
+                    for i, shard in enumerate(shards)]
+    for process in processes:
+        process.start()
+    try:
+        n_running = len(processes)
+        while n_running:
+            try:
+                ret = results.get(timeout=1)
+            except six.moves.queue.Empty:
+                # A process that is killed does not say goodbye.
+                for process in processes:
+                    if process.exitcode:
+                        raise Exception('process {0} exited with {1}'.format(
+                                            process.pid, process.exitcode))
+                continue
+            if ret is None:
+                n_running -= 1
+            elif isinstance(ret, Exception):
+                raise ret
+            else:
+                yield ret
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
 def yaml_str(s):
     """ Escapes the string for inclusion in YAML. """
     if not isinstance(s, six.string_types):
         s = s.decode('utf-8')
+    import yaml
     ret = yaml.dump(s)
     if ret.endswith('\n'):
         ret = ret[:-1]
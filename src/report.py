@@ -0,0 +1,163 @@
+""" Reports the results of checking the servers as they come in.
+
+    Every result is turned into an event (a dict), which is written either
+    as human readable text or as a line of JSON.
+
+    In summary mode, the servers that (should) change are not reported one
+    by one.  Instead, they are grouped by the keys that are added to and
+    removed from them, and every group is reported once at the end. """
+import sys
+import json
+import textwrap
+import threading
+import collections
+
+import claviger.scp
+
+class Reporter(object):
+    """ Base class of the reporters.  Can be used from several threads. """
+    def __init__(self, dry_run, verbosity=0, out=None, summary=False):
+        self.dry_run = dry_run
+        self.verbosity = verbosity
+        self.out = out if out is not None else sys.stdout
+        self.summary = summary
+        self.lock = threading.Lock()
+        self.n_servers = 0
+        self.changed = []
+        self.failed = []
+        # Maps the changes of servers (as JSON) to the list of servers with
+        # those changes, in summary mode.
+        self.change_sets = collections.OrderedDict()
+
+    def report(self, ret):
+        """ Reports the claviger.worker.JobReturn of a server. """
+        event = server_event(ret)
+        with self.lock:
+            self.n_servers += 1
+            if event['status'] in ('error', 'hostkey'):
+                self.failed.append(event['server'])
+            elif event['status'] == 'changed':
+                self.changed.append(event['server'])
+                if self.summary:
+                    self.change_sets.setdefault(json.dumps(event['changes'],
+                                    sort_keys=True), []).append(
+                                                    event['server'])
+                    return
+            self.emit(event)
+            self.out.flush()
+
+    def finish(self):
+        """ Reports the outcome of the whole run. """
+        with self.lock:
+            # The largest groups first
+            for changes, servers in sorted(self.change_sets.items(),
+                                           key=lambda x: -len(x[1])):
+                self.emit({'event': 'changes',
+                           'changes': json.loads(changes),
+                           'servers': sorted(servers)})
+            if self.failed:
+                status = 'errors'
+            elif self.changed:
+                status = 'changes'
+            else:
+                status = 'in-order'
+            self.emit({'event': 'summary',
+                       'status': status,
+                       'dry_run': self.dry_run,
+                       'n_servers': self.n_servers,
+                       'changed': self.changed,
+                       'failed': self.failed})
+            self.out.flush()
+
+    def emit(self, event):
+        raise NotImplementedError
+
+def server_event(ret):
+    """ Converts a claviger.worker.JobReturn to an event. """
+    event = {'event': 'server',
+             'server': ret.server_name,
+             'duration': ret.duration}
+    if not ret.ok:
+        if isinstance(ret.result, claviger.scp.HostKeyVerificationFailed):
+            event['status'] = 'hostkey'
+        else:
+            event['status'] = 'error'
+        event['error'] = str(ret.result)
+        return event
+    res = ret.result
+    event.update({'status': ('changed' if res.n_keys_added
+                                        or res.n_keys_removed else 'ok'),
+                  'added': res.n_keys_added,
+                  'removed': res.n_keys_removed,
+                  'ignored': res.n_keys_ignored,
+                  'diff': res.diff,
+                  'changes': [{'user': user, 'added': added,
+                               'removed': removed}
+                                for user, added, removed in res.changes]})
+    return event
+
+class JSONReporter(Reporter):
+    """ Writes every event as a line of JSON. """
+    def emit(self, event):
+        self.out.write(json.dumps(event, sort_keys=True))
+        self.out.write('\n')
+
+class TextReporter(Reporter):
+    """ Writes the events in a human readable form. """
+    def emit(self, event):
+        getattr(self, '_emit_' + event['event'])(event)
+
+    def _print(self, s=''):
+        self.out.write(s)
+        self.out.write('\n')
+
+    def _emit_server(self, event):
+        if event['status'] == 'hostkey':
+            self._print("{0:<40} host key verification failed".format(
+                            event['server']))
+            return
+        if event['status'] == 'error':
+            self._print()
+            self._print("{0:<40} error".format(event['server']))
+            self._print("   {0}".format(event['error']))
+            self._print()
+            return
+        if event['status'] == 'ok' and not self.verbosity:
+            return
+        if event['diff']:
+            self._print(event['diff'])
+        self._print("{0:<40} +{1:<2} -{2:<2} ?{3:<2}".format(event['server'],
+                        event['added'], event['removed'], event['ignored']))
+
+    def _emit_changes(self, event):
+        servers = event['servers']
+        self._print()
+        self._print('{0} server{1}:'.format(len(servers),
+                                            '' if len(servers) == 1 else 's'))
+        for change in event['changes']:
+            for label in change['added']:
+                self._print('  {0}: + {1}'.format(change['user'], label))
+            for label in change['removed']:
+                self._print('  {0}: - {1}'.format(change['user'], label))
+        self._print(textwrap.fill(' '.join(servers), initial_indent='    ',
+                                  subsequent_indent='    ',
+                                  break_on_hyphens=False))
+
+    def _emit_summary(self, event):
+        if event['status'] == 'in-order':
+            self._print('Everything is in order.')
+        elif event['status'] == 'changes' and self.dry_run:
+            self._print()
+            self._print("This is a dry run: no changes have been made.")
+            if self.summary:
+                self._print("Run `claviger SERVER' to see the diff of "
+                            "a server.")
+            self._print("Rerun with `-f' to apply changes.")
+        elif event['status'] == 'errors':
+            self._print()
+            self._print('Checking some servers failed.  See above.')
+            if self.dry_run:
+                self._print("This is a dry run: no changes have been made.")
+
+# Maps the names of the output formats to their reporters
+REPORTERS = {'text': TextReporter, 'json': JSONReporter}
@@ -0,0 +1,146 @@
+""" Decides in which order the servers are checked.
+
+    Servers can be put in a group (for instance: all servers behind the
+    same jump host) with a limit on the number of connections to the group
+    at the same time.  The Scheduler hands out jobs round-robin over the
+    groups, skipping those that are at their limit. """
+import sys
+import heapq
+import collections
+
+import six
+
+def server_group(job):
+    """ Returns the group of the server of job and the limit on the number
+        of connections to that group. """
+    if job.server['group'] is None:
+        # Servers without a group are not limited: groupConnections would
+        # limit the connections to the server itself, of which there is
+        # only one anyway.
+        return None, None
+    return job.server['group'], job.server['groupConnections']
+
+class Scheduler(object):
+    """ Hands out jobs such that of every group at most its limit are
+        running at the same time.  Call next() to get a job to run and
+        done(job) when it has finished.
+
+        Jobs are taken from the iterable jobs as they are needed: at most
+        lookahead of them are pending at the same time, unless all of those
+        are in groups at their limit.  Then jobs are taken until one turns
+        up that can run. """
+    def __init__(self, jobs, group_of=server_group, lookahead=256):
+        self._jobs = iter(jobs)
+        self._lookahead = lookahead
+        self._group_of = group_of
+        self._queues = {}
+        self._limits = {}
+        self._running = collections.Counter()
+        self.n_pending = 0
+        # The groups with pending jobs, that are not at their limit
+        self._ready = collections.deque()
+
+    def _fill(self):
+        """ Takes jobs until lookahead of them are pending and one of them
+            can run, or until there are no more jobs. """
+        while self.n_pending < self._lookahead or not self._ready:
+            job = next(self._jobs, None)
+            if job is None:
+                return
+            group, limit = self._group_of(job)
+            if limit is None:
+                limit = float('inf')
+            # If the servers in a group disagree, the strictest limit wins.
+            self._limits[group] = min(limit, self._limits.get(group, limit))
+            queue = self._queues.get(group)
+            if queue is None:
+                queue = self._queues[group] = collections.deque()
+            if not queue and self._running[group] < self._limits[group]:
+                self._ready.append(group)
+            queue.append(job)
+            self.n_pending += 1
+
+    def next(self):
+        """ Returns the next job to run, or None if there is no job or all
+            groups with pending jobs are at their limit. """
+        while True:
+            self._fill()
+            if not self._ready:
+                return None
+            group = self._ready.popleft()
+            # A job taken later might have lowered the limit of the group.
+            if (self._queues[group]
+                    and self._running[group] < self._limits[group]):
+                break
+        job = self._queues[group].popleft()
+        self._running[group] += 1
+        self.n_pending -= 1
+        if self._queues[group] and self._running[group] < self._limits[group]:
+            self._ready.append(group)
+        return job
+
+    def done(self, job):
+        """ Marks job, which was returned by next(), as finished. """
+        group = self._group_of(job)[0]
+        self._running[group] -= 1
+        if (self._queues[group]
+                and self._running[group] == self._limits[group] - 1):
+            # The group was at its limit, but is not anymore.
+            self._ready.append(group)
+
+def shard(jobs, n, group_of=server_group):
+    """ Divides jobs over n lists of about the same length, such that the
+        jobs of a group with a limit end up in the same list.  The lists
+        keep the order of jobs. """
+    units = collections.OrderedDict()
+    for i, job in enumerate(jobs):
+        group, limit = group_of(job)
+        units.setdefault((group,) if limit is not None else (group, i),
+                         []).append((i, job))
+    # Hand out the largest units first, each to the shortest list so far.
+    heap = [(0, i) for i in range(n)]
+    shards = [[] for _ in range(n)]
+    for unit in sorted(six.itervalues(units), key=len, reverse=True):
+        length, i = heapq.heappop(heap)
+        shards[i].extend(unit)
+        heapq.heappush(heap, (length + len(unit), i))
+    return [[job for _, job in sorted(part, key=lambda x: x[0])]
+                for part in shards]
+
+def run_sequentially(func, scheduler):
+    """ Calls func on the jobs from scheduler one after the other and
+        yields the results. """
+    while True:
+        job = scheduler.next()
+        if job is None:
+            return
+        ret = func(job)
+        scheduler.done(job)
+        yield ret
+
+def run_threaded(func, scheduler, pool, n_threads):
+    """ Calls func on the jobs from scheduler, on at most n_threads threads
+        of the multiprocessing.dummy.Pool pool at the same time.  Yields
+        the results as they become available. """
+    results = six.moves.queue.Queue()
+    def call(job):
+        try:
+            results.put((job, func(job), None))
+        except Exception:
+            results.put((job, None, sys.exc_info()))
+    running = 0
+    while True:
+        while running < n_threads:
+            job = scheduler.next()
+            if job is None:
+                break
+            pool.apply_async(call, (job,))
+            running += 1
+        if not running:
+            return
+        job, ret, exc_info = results.get()
+        running -= 1
+        scheduler.done(job)
+        if exc_info is not None:
+            six.reraise(*exc_info)
+        yield ret
@@ -0,0 +1,47 @@
+""" The JSON schema of the configuration file.
+
+    It is kept as a Python structure, such that loading it is free. """
+# TODO generate documention from schema?
+
+_KEY_NAMES = {'type': 'array', 'items': {'type': 'string'}}
+
+SCHEMA = {
+    'type': 'object',
+    'required': ['keys', 'servers'],
+    'properties': {
+        'keys': {
+            'type': 'object',
+            'default': {},
+            'additionalProperties': {
+                'type': 'string',
+                # TODO ... or with object with keys
+                #       {comment, key, keyname, options}
+            },
+        },
+        'servers': {
+            'type': 'object',
+            'additionalProperties': {
+                'type': 'object',
+                'properties': {
+                    'name': {'type': 'string'},
+                    'hostname': {'type': 'string'},
+                    'port': {'type': 'integer'},
+                    'user': {'oneOf': [
+                        {'type': 'string'},
+                        {'type': 'array', 'items': {'type': 'string'},
+                         'minItems': 1}]},
+                    'ssh_user': {'type': 'string'},
+                    'absent': _KEY_NAMES,
+                    'present': _KEY_NAMES,
+                    'allow': _KEY_NAMES,
+                    'like': {'type': 'string'},
+                    'keepOtherKeys': {'type': 'boolean'},
+                    'group': {'type': 'string'},
+                    'groupConnections': {'type': 'integer', 'minimum': 1},
+                },
+                'additionalProperties': False,
+            },
+        },
+    },
+    'additionalProperties': False,
+}
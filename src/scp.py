@@ -1,54 +1,317 @@
 import os.path
 import logging
+import random
+import re
 import tempfile
+import threading
 import subprocess
 
+import six
+
 l = logging.getLogger(__name__)
 
 class SCP(object):
+    """ Creates sessions to servers.
+
+        All sessions to the same (ssh_user, hostname, port) share a single
+        multiplexed SSH master connection (see ControlMaster in ssh_config(5)),
+        which is kept open until close() is called.
+
+        If connect_timeout is set, ssh gives up on connecting to a server
+        after that many seconds.  If timeout is set, every ssh and scp
+        process is killed after running that many seconds.  A check of a
+        server that fails with a TransientSCPError is retried up to retries
+        times, after a random delay that doubles every attempt, starting
+        at (on average) backoff seconds. """
+    def __init__(self, multiplex=True, control_persist=600,
+                 connect_timeout=None, timeout=None, retries=0, backoff=1.0):
+        self.multiplex = multiplex
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._control_dir = None
+        self._masters = set()
+        self._scp_options = None
+        self._lock = threading.Lock()
+
     def connect(self, hostname, port,  ssh_user):
-        return SCPSession(hostname, port, ssh_user)
+        return SCPSession(hostname, port, ssh_user, self)
+
+    def scp_options(self):
+        """ Returns the options to pass to scp to make it use the scp
+            protocol, which passes paths through the remote shell, instead
+            of SFTP, the default since OpenSSH 9.0.  scp before OpenSSH 8.7
+            only speaks the scp protocol and rejects the option, so we
+            check once whether its usage lists it. """
+        with self._lock:
+            if self._scp_options is None:
+                self._scp_options = (['-O'] if scp_knows_option('O')
+                                        else [])
+            return self._scp_options
 
+    def ssh_options(self, hostname, port, ssh_user):
+        """ Returns the options to pass to ssh or scp to reuse the master
+            connection to the given server. """
+        ret = []
+        if self.connect_timeout:
+            ret += ['-o', 'ConnectTimeout={0}'.format(self.connect_timeout)]
+        if not self.multiplex:
+            return ret
+        with self._lock:
+            if self._control_dir is None:
+                self._control_dir = tempfile.mkdtemp(prefix='claviger-')
+            self._masters.add((ssh_user, hostname, port))
+        return ret + ['-o', 'ControlMaster=auto',
+                      '-o', 'ControlPath={0}'.format(
+                                os.path.join(self._control_dir, '%C')),
+                      '-o', 'ControlPersist={0}'.format(self.control_persist)]
 
-def interpret_scp_error(exitcode, stderr, stdout):
+    def retry_delay(self, attempt):
+        """ Returns how many seconds to wait before retrying for the
+            attempt-th time, or None if we should give up. """
+        if attempt > self.retries:
+            return None
+        # "Full jitter": servers that failed at the same moment (for
+        # instance because their jump host hiccuped) do not all come back
+        # at the same moment.
+        return random.uniform(0, 2 * self.backoff * 2 ** (attempt - 1))
+
+    def close(self):
+        """ Tears down all master connections. """
+        with self._lock:
+            control_dir, self._control_dir = self._control_dir, None
+            masters, self._masters = self._masters, set()
+        if control_dir is None:
+            return
+        for ssh_user, hostname, port in masters:
+            cmd = ['ssh', '-o', 'ControlPath={0}'.format(
+                                os.path.join(control_dir, '%C')),
+                   '-O', 'exit', '-p', str(port),
+                   '{0}@{1}'.format(ssh_user, hostname)]
+            l.debug('executing %s', cmd)
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        try:
+            for fn in os.listdir(control_dir):
+                os.unlink(os.path.join(control_dir, fn))
+            os.rmdir(control_dir)
+        except OSError as e:
+            l.warning('could not remove %s: %s', control_dir, e)
+
+
+class SSH(SCP):
+    """ Like SCP, but creates SSHSessions, which fetch and write back
+        the authorized_keys file over a single ssh session. """
+    def connect(self, hostname, port,  ssh_user):
+        return SSHSession(hostname, port, ssh_user, self)
+
+# Maps the names of the transports to their classes
+TRANSPORTS = {'scp': SCP, 'ssh': SSH}
+
+# Messages of ssh that indicate a failure that might go away if we try again
+_TRANSIENT_ERRORS = (
+        'ssh_exchange_identification',
+        'kex_exchange_identification',
+        'Connection timed out',
+        'Connection reset by peer',
+        'Connection closed by remote host',
+        'Temporary failure in name resolution',
+        'Broken pipe',
+    )
+
+# The flags in the usage message of scp, like "usage: scp [-346BCpqrv]"
+_SCP_USAGE_FLAGS = re.compile(r'usage: scp \[-([0-9A-Za-z]+)\]')
+
+def scp_knows_option(option):
+    """ Returns whether the flag option is in the usage message that scp
+        prints when it is run without files. """
+    try:
+        p = subprocess.Popen(['scp', '-' + option], stdin=subprocess.PIPE,
+                                                    stdout=subprocess.PIPE,
+                                                    stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    stdout, stderr = p.communicate()
+    m = _SCP_USAGE_FLAGS.search((stdout + stderr).decode('utf-8', 'replace'))
+    return m is not None and option in m.group(1)
+
+def interpret_scp_error(exitcode, stderr, stdout, program='scp'):
     """ Interpret the output of `scp' and create a suitable exception """
     if 'Host key verification failed' in stderr:
         return HostKeyVerificationFailed()
-    msg = 'scp failed: exitcode {0}'.format(exitcode)
+    msg = '{0} failed: exitcode {1}'.format(program, exitcode)
     if stderr.strip():
         msg += '; stderr {0}'.format(repr(stderr))
     if stdout.strip():
         msg += '; stdout {0}'.format(repr(stdout))
+    if any(error in stderr for error in _TRANSIENT_ERRORS):
+        return TransientSCPError(msg)
     return SCPError(msg)
 
+# Shell script that prints the home directory and uid of a user and the
+# AuthorizedKeysFile setting of sshd that applies to the user.  sshd -T
+# usually requires root, in which case we fall back to the global setting
+# in sshd_config.
+_DISCOVER_SCRIPT = """u={user}
+h=$(getent passwd "$u" 2>/dev/null | cut -d: -f6)
+[ -n "$h" ] || h=$(eval echo ~$u)
+echo "$h"
+id -u "$u" 2>/dev/null || echo
+s="user=$u,host=localhost,addr=127.0.0.1"
+f=$( (sshd -T -C "$s" || /usr/sbin/sshd -T -C "$s") 2>/dev/null |
+        awk 'tolower($1) == "authorizedkeysfile" {{ $1 = ""; print; exit }}')
+[ -n "$f" ] || f=$(awk 'tolower($1) == "match" {{ exit }}
+        tolower($1) == "authorizedkeysfile" {{ $1 = ""; print; exit }}' \\
+            /etc/ssh/sshd_config 2>/dev/null)
+echo "$f"
+"""
+
+def parse_discovery(output, user):
+    """ Returns the path of the authorized_keys file of user from the output
+        of _DISCOVER_SCRIPT, or None if it could not be determined.
+
+        If sshd is configured with several AuthorizedKeysFiles, the
+        first is used. """
+    lines = output.split('\n')
+    if len(lines) < 3 or not lines[0].startswith('/'):
+        return None
+    home, uid, setting = lines[0], lines[1].strip(), lines[2].split()
+    if not setting:
+        setting = ['.ssh/authorized_keys']
+    if setting[0].lower() == 'none':
+        raise SCPError('sshd does not use an authorized_keys file for '
+                       '{0}'.format(user))
+    tokens = {'%%': '%', '%h': home, '%u': user, '%U': uid}
+    if any(token not in tokens for token in re.findall('%.', setting[0])):
+        return None
+    path = re.sub('%.', lambda m: tokens[m.group(0)], setting[0])
+    return os.path.join(home, path)
+
+def parse_digest(output):
+    """ Extracts the digest from the output of sha256sum """
+    bits = output.split()
+    if not bits or len(bits[0]) != 64:
+        raise SCPError('unexpected output of sha256sum: {0}'.format(
+                                repr(output)))
+    return bits[0].lower()
+
+# Usernames we are willing to put unquoted in a shell script
+_USER_RE = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
 class SCPError(Exception):
     pass
 class HostKeyVerificationFailed(SCPError):
     pass
+class TransientSCPError(SCPError):
+    """ A failure, like a dropped connection, that might not occur again
+        if we retry. """
+    pass
+class SCPTimeout(SCPError):
+    pass
+
+class _Deadline(object):
+    """ Kills the process p if it is still running after timeout seconds,
+        unless timeout is None. """
+    def __init__(self, p, timeout):
+        self.expired = False
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._expire, (p,))
+            self._timer.daemon = True
+            self._timer.start()
+    def _expire(self, p):
+        self.expired = True
+        try:
+            p.kill()
+        except OSError:
+            pass
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
 
 class SCPSession(object):
-    def __init__(self, hostname, port, ssh_user):
+    def __init__(self, hostname, port, ssh_user, scp=None):
         self.hostname = hostname
         self.port = port if port else 22
         self.ssh_user = ssh_user
+        self.scp = scp if scp is not None else SCP(multiplex=False)
+        # Maps users to the paths of their authorized_keys files, if known
+        self.paths = {}
     def _path_for(self, user):
-        # TODO read passwd or use SSH session to find home
+        """ Returns the path of the authorized_keys file of user, quoted
+            for the remote shell. """
+        if user in self.paths:
+            return six.moves.shlex_quote(self.paths[user])
         return os.path.join('~' + user, '.ssh', 'authorized_keys')
+    def _scp_cmd(self, src, trg):
+        return (['scp', '-B'] + self.scp.scp_options()
+                + ['-P', str(self.port)]
+                + self.scp.ssh_options(self.hostname, self.port,
+                                       self.ssh_user)
+                + [src, trg])
+    def _ssh_cmd(self, remote_cmd):
+        return (['ssh', '-o', 'BatchMode=yes', '-p', str(self.port)]
+                + self.scp.ssh_options(self.hostname, self.port,
+                                       self.ssh_user)
+                + ['{0}@{1}'.format(self.ssh_user, self.hostname),
+                   remote_cmd])
+    def _digest_cmd(self, user):
+        if not _USER_RE.match(user):
+            raise SCPError('unsupported username {0}'.format(repr(user)))
+        path = self._path_for(user)
+        return self._ssh_cmd(('sha256sum {0} 2>/dev/null || '
+                              'shasum -a 256 {0}').format(path))
+    def _discover_cmd(self, user):
+        if not _USER_RE.match(user):
+            raise SCPError('unsupported username {0}'.format(repr(user)))
+        return self._ssh_cmd('sh -c ' + six.moves.shlex_quote(
+                                _DISCOVER_SCRIPT.format(user=user)))
+    def _remote_path(self, user):
+        # FIXME escaping
+        return '{0}@{1}:{2}'.format(self.ssh_user, self.hostname,
+                                    self._path_for(user))
     def _scp(self, src, trg):
-        cmd = ['scp', '-B', '-P', str(self.port), src, trg]
+        self._run(self._scp_cmd(src, trg))
+
+    def _run(self, cmd):
+        """ Runs cmd and returns its output """
         l.debug('executing %s', cmd)
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                   stderr=subprocess.PIPE)
-        stdout_txt, stderr_txt = [x.decode('utf-8') for x in p.communicate()]
+        deadline = _Deadline(p, self.scp.timeout)
+        try:
+            stdout_txt, stderr_txt = [x.decode('utf-8')
+                                        for x in p.communicate()]
+        finally:
+            deadline.cancel()
+        if deadline.expired:
+            raise SCPTimeout('{0} timed out'.format(cmd[0]))
         if p.returncode != 0:
-            raise interpret_scp_error(p.returncode, stderr_txt, stdout_txt)
+            raise interpret_scp_error(p.returncode, stderr_txt, stdout_txt,
+                                      cmd[0])
+        return stdout_txt
+
+    def digest(self, user):
+        """ Returns the hex SHA-256 digest of the authorized_keys file,
+            which is cheaper than fetching it. """
+        return parse_digest(self._run(self._digest_cmd(user)))
+
+    def discover(self, user):
+        """ Finds out where the authorized_keys file of user is, remembers
+            it for the other methods and returns it.  Returns None if that
+            could not be determined, in which case the default
+            ~user/.ssh/authorized_keys is used. """
+        path = parse_discovery(self._run(self._discover_cmd(user)), user)
+        if path is not None:
+            self.paths[user] = path
+        return path
 
     def get(self, user):
         with tempfile.NamedTemporaryFile() as tempf:
-            # FIXME escaping
             # TODO check for error
-            self._scp('{0}@{1}:{2}'.format(self.ssh_user, self.hostname,
-                            self._path_for(user)), tempf.name)
+            self._scp(self._remote_path(user), tempf.name)
             return tempf.read()
         # TODO create .ssh if it does not exist
         # TODO check permissions
@@ -57,5 +320,138 @@ class SCPSession(object):
         with tempfile.NamedTemporaryFile() as tempf:
             tempf.write(authorized_keys)
             tempf.flush()
-            self._scp(tempf.name, '{0}@{1}:{2}'.format(self.ssh_user,
-                            self.hostname, self._path_for(user)))
+            self._scp(tempf.name, self._remote_path(user))
+    def get_many(self, users):
+        """ Returns the authorized_keys files of users. """
+        return [self.get(user) for user in users]
+    def put_many(self, users, authorized_keyss):
+        """ Writes the authorized_keys files of users, skipping those
+            for which authorized_keyss has None. """
+        for user, authorized_keys in zip(users, authorized_keyss):
+            if authorized_keys is not None:
+                self.put(user, authorized_keys)
+    def close(self):
+        """ Called when done with the session. """
+        pass
+
+# Shell script run on the server by SSHSession.  For each of the given
+# authorized_keys files, it writes the size and contents to stdout.  Then,
+# for each file in turn, it reads either `keep' or `put <size>' followed by
+# the new contents from stdin.  The new contents are written to a copy (to
+# preserve ownership and permissions), which is then renamed over the
+# original.  We use dd with a block size of one byte, as head might read
+# beyond the contents of the file into those of the next.
+_SSH_SCRIPT = """set -e
+t=
+trap 'rm -f "$t"' EXIT
+for f in {paths}; do
+    wc -c < "$f"
+    cat "$f"
+done
+for f in {paths}; do
+    read cmd size
+    if [ "$cmd" = put ]; then
+        t="$f.claviger.$$"
+        cp -p "$f" "$t"
+        dd bs=1 count="$size" of="$t" 2>/dev/null
+        mv "$t" "$f"
+        t=
+    fi
+done
+"""
+
+def read_stderr(f):
+    """ Returns what was written to the temporary file f and closes it. """
+    with f:
+        f.seek(0)
+        return f.read().decode('utf-8')
+
+def unexpected_output_error(finish_error):
+    """ Returns the error to raise if the output of the ssh session is not
+        what _SSH_SCRIPT prints.  finish_error is the error that ssh exited
+        with, if any. """
+    if isinstance(finish_error, (HostKeyVerificationFailed,
+                                 TransientSCPError, SCPTimeout)):
+        # ssh itself failed, which cut the output short.
+        return finish_error
+    msg = 'ssh: unexpected output from server'
+    if finish_error is not None:
+        msg += '; {0}'.format(finish_error)
+    return SCPError(msg)
+
+class SSHSession(SCPSession):
+    """ Fetches the authorized_keys files of the users and writes them
+        back within one ssh session. """
+    def __init__(self, hostname, port, ssh_user, scp=None):
+        super(SSHSession, self).__init__(hostname, port, ssh_user, scp)
+        self._p = None
+        self._deadline = None
+        self._users = None
+        # stderr goes to a file: ssh would block on a full pipe, while we
+        # only read stdout until we finish.
+        self._stderr = None
+    def _get_cmd(self, users):
+        for user in users:
+            if not _USER_RE.match(user):
+                raise SCPError('unsupported username {0}'.format(
+                                                    repr(user)))
+        script = _SSH_SCRIPT.format(paths=' '.join(
+                                self._path_for(user) for user in users))
+        return self._ssh_cmd('sh -c ' + six.moves.shlex_quote(script))
+    def _put_cmd(self, authorized_keyss):
+        ret = []
+        for authorized_keys in authorized_keyss:
+            if authorized_keys is None:
+                ret.append(b'keep\n')
+            else:
+                ret.append(six.b('put {0}\n'.format(len(authorized_keys))))
+                ret.append(authorized_keys)
+        return b''.join(ret)
+    def get(self, user):
+        return self.get_many([user])[0]
+    def put(self, user, authorized_keys):
+        self.put_many([user], [authorized_keys])
+    def get_many(self, users):
+        if self._p is not None:
+            raise SCPError('SSHSession can only handle one get')
+        cmd = self._get_cmd(users)
+        l.debug('executing %s', cmd)
+        self._stderr = tempfile.TemporaryFile()
+        self._p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=self._stderr)
+        self._deadline = _Deadline(self._p, self.scp.timeout)
+        self._users = list(users)
+        ret = []
+        for user in users:
+            try:
+                size = int(self._p.stdout.readline())
+            except ValueError:
+                size = None
+            data = self._p.stdout.read(size) if size is not None else b''
+            if size is None or len(data) != size:
+                try:
+                    self._finish(b'')
+                except SCPError as e:
+                    raise unexpected_output_error(e)
+                raise unexpected_output_error(None)
+            ret.append(data)
+        return ret
+    def put_many(self, users, authorized_keyss):
+        if self._p is None or list(users) != self._users:
+            raise SCPError('SSHSession: put without matching get')
+        self._finish(self._put_cmd(authorized_keyss))
+    def close(self):
+        if self._p is not None:
+            self._finish(self._put_cmd([None] * len(self._users)))
+    def _finish(self, stdin_data):
+        p, self._p = self._p, None
+        try:
+            stdout = p.communicate(stdin_data)[0].decode('utf-8')
+        finally:
+            self._deadline.cancel()
+        stderr = read_stderr(self._stderr)
+        if self._deadline.expired:
+            raise SCPTimeout('ssh timed out')
+        if p.returncode != 0:
+            raise interpret_scp_error(p.returncode, stderr, stdout, 'ssh')
@@ -0,0 +1,76 @@
+import sys
+import hashlib
+import tempfile
+import unittest
+
+# The asyncio engine requires Python 3.5.  This module must still import
+# on older versions, so it does not contain coroutines itself.
+if sys.version_info >= (3, 5):
+    import asyncio
+
+    import claviger.aio
+    import claviger.scp
+
+    class LocalSSHSession(claviger.aio.AsyncSSHSession):
+        """ Runs the shell command prefix, followed by the remote commands,
+            locally on the file path. """
+        prefix = ''
+        def _ssh_cmd(self, remote_cmd):
+            return ['sh', '-c', self.prefix + remote_cmd]
+        def _path_for(self, user):
+            return self.path
+
+AUTHORIZED_KEYS = b'ssh-rsa AAAAB3NzaC1yc2EAAAA= user@example.net\n'
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs Python 3.5')
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_coroutine(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_ssh_cached_digest(self):
+        # The digest that is checked against the state cache must be
+        # fetched by a coroutine as well.
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(AUTHORIZED_KEYS)
+            f.flush()
+            session = LocalSSHSession('example.com', 22, 'root')
+            session.path = f.name
+            self.assertEqual(self.run_coroutine(session.digest('root')),
+                             hashlib.sha256(AUTHORIZED_KEYS).hexdigest())
+            self.run_coroutine(session.close())
+
+    def test_ssh_stderr(self):
+        # More on stderr than fits in a pipe must not block ssh.
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(AUTHORIZED_KEYS)
+            f.flush()
+            session = LocalSSHSession('example.com', 22, 'root',
+                        claviger.aio.AsyncSSH(multiplex=False, timeout=10))
+            session.path = f.name
+            session.prefix = 'head -c 1000000 /dev/zero >&2; '
+            self.assertEqual(self.run_coroutine(session.get('root')),
+                             AUTHORIZED_KEYS)
+            self.run_coroutine(session.close())
+
+    def test_ssh_timeout(self):
+        with tempfile.NamedTemporaryFile() as f:
+            session = LocalSSHSession('example.com', 22, 'root',
+                        claviger.aio.AsyncSSH(multiplex=False, timeout=0.1))
+            session.path = f.name
+            session.prefix = 'exec sleep 10; '
+            with self.assertRaises(claviger.scp.SCPTimeout):
+                self.run_coroutine(session.get('root'))
+            # Closing the session does not replace the timeout by the
+            # exit code of the killed ssh.
+            self.run_coroutine(session.close())
+
+if __name__ == '__main__':
+    unittest.main()
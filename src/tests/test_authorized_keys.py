@@ -1,3 +1,7 @@
+import base64
+import random
+import struct
+import binascii
 import unittest
 import textwrap
 
@@ -19,6 +23,82 @@ SSHD_MAN_PAGE_EXAMPLE = six.b(textwrap.dedent("""
 GRAWITY_EXAMPLE = six.b('ssh-foo="echo \\"Here\'s ssh-rsa for you\\"" '+
                       'future-algo AAAAC2Z1dHVyZS1hbGdv X y z.')
 
+def reference_parse(raw_line):
+    """ The original, character-by-character, version of Entry.parse.
+        Returns (options, keytype, key, comment) or None. """
+    l = raw_line.strip()
+    in_quote = False
+    after_slash = False
+    i = 0
+    while i < len(l):
+        cur = l[i:i+1]
+        if cur == b' ' and not in_quote:
+            break
+        if cur == b'"' and not after_slash:
+            in_quote = not in_quote
+        elif cur == b'\\':
+            after_slash = True
+        else:
+            after_slash = False
+        i += 1
+    first_field, rest = l[:i], l[i:].strip()
+    if reference_check_key(rest.split(b' ')[0], first_field):
+        bits = rest.split(b' ', 1)
+        return (None, first_field, bits[0],
+                None if len(bits) == 1 else bits[1].strip())
+    bits = rest.split(b' ', 1)
+    if not len(bits) == 2:
+        return None
+    last_fields = bits[1].strip().split(b' ', 1)
+    if not reference_check_key(last_fields[0], bits[0]):
+        return None
+    return (first_field, bits[0], last_fields[0],
+            None if len(last_fields) == 1 else last_fields[1].strip())
+
+def reference_check_key(b64key, keytype):
+    try:
+        key = base64.b64decode(b64key)
+    except (TypeError, binascii.Error):
+        return False
+    if len(key) < 5:
+        return False
+    if struct.unpack('>I', key[:4])[0] != len(keytype):
+        return False
+    return key[4:].startswith(keytype)
+
+def fuzzed_corpus(n, seed=0):
+    """ Returns n random, often malformed, authorized_keys lines. """
+    rnd = random.Random(seed)
+    keytypes = [b'ssh-rsa', b'ssh-ed25519', b'ssh-dss', b'future-algo',
+                b'ecdsa-sha2-nistp256', b'']
+    options = [b'no-pty', b'command="echo hi"', b'from="a b"', b'\\"',
+               b'"', b'x="\\" y"', b'a\\\\"b c"', b'restrict', b'" "']
+    ret = []
+    for _ in range(n):
+        keytype = rnd.choice(keytypes)
+        blob_type = keytype if rnd.random() < .8 else rnd.choice(keytypes)
+        blob = (struct.pack('>I', len(blob_type)) + blob_type
+                    + bytes(bytearray(rnd.randrange(256) for _ in
+                                range(rnd.choice([0, 1, 2, 3, 32, 279])))))
+        key = base64.b64encode(blob)
+        mutation = rnd.random()
+        if mutation < .1:
+            key = key[:rnd.randrange(len(key) + 1)]
+        elif mutation < .2:
+            pos = rnd.randrange(len(key) + 1)
+            key = key[:pos] + rnd.choice([b'=', b'!', b'\n', b'==', b'A'])\
+                    + key[pos:]
+        elif mutation < .25:
+            key = key.rstrip(b'=')
+        fields = [keytype, key]
+        if rnd.random() < .5:
+            fields.insert(0, b','.join(rnd.sample(options,
+                                            rnd.randrange(1, 4))))
+        if rnd.random() < .5:
+            fields.append(rnd.choice([b'user@host', b'a b  c', b'"x y"']))
+        ret.append(b' '.join(fields))
+    return ret
+
 class TestAuthorizedKeys(unittest.TestCase):
     def test_man_page_examples(self):
         f = six.BytesIO(SSHD_MAN_PAGE_EXAMPLE)
@@ -51,5 +131,130 @@ class TestAuthorizedKeys(unittest.TestCase):
         ak.removeAllKeys()
         self.assertEqual(len(ak.entries), 0)
 
+    def test_index(self):
+        f = six.BytesIO(SSHD_MAN_PAGE_EXAMPLE)
+        ak = claviger.authorized_keys.parse(f, False)
+        entry = ak.get(b'AAAAB3NzaC1kc3MAAA==')
+        self.assertEqual(entry.comment, b'example.net')
+        ak.add(None, b'ssh-ed25519', b'AAAAC3NzaC1lZDI1NTE5AAAA', b'new')
+        self.assertEqual(ak.get(b'AAAAC3NzaC1lZDI1NTE5AAAA').comment, b'new')
+        self.assertEqual(ak.remove_many([b'AAAAB3NzaC1yc2EAAAA=',
+                                         b'AAAAB3NzaC1kc3MAAA==',
+                                         b'doesnotexist']), 7)
+        self.assertEqual(len(ak.entries), 1)
+        self.assertTrue(ak.contains(b'AAAAC3NzaC1lZDI1NTE5AAAA'))
+        self.assertEqual(ak.get(b'AAAAC3NzaC1lZDI1NTE5AAAA').comment, b'new')
+        self.assertEqual(six.binary_type(ak).count(b'\n'), 3)
+
+    def test_remove_one_by_one(self):
+        ak = claviger.authorized_keys.parse(b''.join(
+                    b'ssh-dss ' + key + b' ' + comment + b'\n'
+                    for key, comment in ((b'AAAAB3NzaC1kc3MAAA==', b'a'),
+                                         (b'AAAAB3NzaC1kc3MAAQ==', b'b'),
+                                         (b'AAAAB3NzaC1kc3MAAg==', b'c'),
+                                         (b'AAAAB3NzaC1kc3MAAw==', b'd'))))
+        self.assertEqual(ak.remove(b'AAAAB3NzaC1kc3MAAQ=='), 1)
+        self.assertEqual(ak.remove(b'AAAAB3NzaC1kc3MAAQ=='), 0)
+        self.assertEqual(ak.remove(b'AAAAB3NzaC1kc3MAAA=='), 1)
+        # The other entries are still found ...
+        self.assertEqual(ak.get(b'AAAAB3NzaC1kc3MAAw==').comment, b'd')
+        ak.add(None, b'ssh-dss', b'AAAAB3NzaC1kc3MABA==', b'e')
+        self.assertEqual(ak.get(b'AAAAB3NzaC1kc3MABA==').comment, b'e')
+        # ... also after the removed ones are dropped from lines.
+        self.assertEqual([line.comment for line in ak.lines],
+                         [b'c', b'd', b'e'])
+        self.assertEqual(ak.get(b'AAAAB3NzaC1kc3MAAg==').comment, b'c')
+        self.assertEqual(ak.remove(b'AAAAB3NzaC1kc3MAAg=='), 1)
+        self.assertEqual(six.binary_type(ak),
+                         b'ssh-dss AAAAB3NzaC1kc3MAAw== d\n'
+                         b'ssh-dss AAAAB3NzaC1kc3MABA== e\n')
+
+    def test_reconcile(self):
+        f = six.BytesIO(SSHD_MAN_PAGE_EXAMPLE)
+        ak = claviger.authorized_keys.parse(f, False)
+        new = claviger.authorized_keys.Entry(None, b'ssh-ed25519',
+                                    b'AAAAC3NzaC1lZDI1NTE5AAAA', b'new')
+        plan = claviger.authorized_keys.reconcile(ak, [new],
+                        absent=[b'AAAAB3NzaC1kc3MAAA=='])
+        self.assertEqual(plan.added, [new])
+        self.assertEqual(len(plan.removed), 2)
+        self.assertEqual(len(plan.ignored), 5)
+        self.assertEqual(len(plan.result.entries), 6)
+        self.assertFalse(plan.result.contains(b'AAAAB3NzaC1kc3MAAA=='))
+        self.assertEqual(len(ak.entries), 7)
+
+        plan = claviger.authorized_keys.reconcile(ak, [new, new],
+                        allow=[b'AAAAB3NzaC1kc3MAAA=='], keepOtherKeys=False)
+        self.assertEqual(plan.added, [new])
+        self.assertEqual(len(plan.removed), 5)
+        self.assertEqual(plan.ignored, [])
+        self.assertEqual(six.binary_type(plan.result).count(b'\n'), 5)
+
+    def test_policy(self):
+        new = claviger.authorized_keys.Entry(None, b'ssh-ed25519',
+                                    b'AAAAC3NzaC1lZDI1NTE5AAAA', b'new')
+        policy = claviger.authorized_keys.make_policy([new, new],
+                        allow=[b'AAAAB3NzaC1kc3MAAA=='], keepOtherKeys=False)
+        self.assertEqual(policy.present, (new,))
+        self.assertEqual(policy.allowed, frozenset([new.key,
+                                                   b'AAAAB3NzaC1kc3MAAA==']))
+        # One policy can be enforced on several files.
+        for _ in range(2):
+            ak = claviger.authorized_keys.parse(SSHD_MAN_PAGE_EXAMPLE)
+            plan = claviger.authorized_keys.enforce(ak, policy)
+            self.assertEqual(plan.added, [new])
+            self.assertEqual(len(plan.removed), 5)
+
+    def test_fingerprint(self):
+        fingerprint = claviger.authorized_keys.fingerprint
+        # ssh-keygen -l on the key laptop in the README
+        self.assertEqual(fingerprint(b'AAAAC3NzaC1lZDI1NTE5AAAAINYZEwjtu8w9'
+                                     b'Hsvx85TlYE95MLV9Whc3N1ajrH7+gu7A'),
+                         'SHA256:R1NQGxlb9Yhm809+cofh4XjWr0yImDrm+zgrYmoyj58')
+        # The unused bits of the last character do not matter.
+        e = claviger.authorized_keys.Entry.parse(
+                                b'ssh-dss AAAAB3NzaC1kc3MAAB== variant')
+        self.assertEqual(e.canonical_key, b'AAAAB3NzaC1kc3MAAA==')
+        self.assertEqual(e.fingerprint, fingerprint(b'AAAAB3NzaC1kc3MAAA=='))
+        self.assertEqual(e.blob, b'\x00\x00\x00\x07ssh-dss\x00\x00')
+        ak = claviger.authorized_keys.parse(SSHD_MAN_PAGE_EXAMPLE)
+        self.assertTrue(ak.contains(b'AAAAB3NzaC1kc3MAAB=='))
+        plan = claviger.authorized_keys.reconcile(ak, [e])
+        self.assertEqual(plan.added, [])
+        plan = claviger.authorized_keys.reconcile(ak, [],
+                        absent=[b'AAAAB3NzaC1kc3MAAB=='])
+        self.assertEqual(len(plan.removed), 2)
+        # ... but other characters do: sshd rejects this line.
+        bad = claviger.authorized_keys.Entry.parse(
+                                b'ssh-dss AAAAB3NzaC1k!c3MAAA== bad')
+        self.assertEqual(bad.canonical_key, b'AAAAB3NzaC1k!c3MAAA==')
+        ak = claviger.authorized_keys.parse(bad.raw_line + b'\n')
+        self.assertFalse(ak.contains(b'AAAAB3NzaC1kc3MAAA=='))
+        plan = claviger.authorized_keys.reconcile(ak, [e])
+        self.assertEqual(plan.added, [e])
+
+    def test_lazy_raw_line(self):
+        raw_line = b' ssh-rsa  AAAAB3NzaC1yc2EAAAA= a '
+        e = claviger.authorized_keys.Entry.parse(raw_line)
+        self.assertEqual(e.raw_line, raw_line)
+        self.assertFalse(hasattr(e, '__dict__'))
+        e.comment = b'b'
+        self.assertEqual(e.raw_line, b'ssh-rsa AAAAB3NzaC1yc2EAAAA= b')
+        e.options = b'no-pty'
+        g = six.BytesIO()
+        e.store(g)
+        self.assertEqual(g.getvalue(),
+                         b'no-pty ssh-rsa AAAAB3NzaC1yc2EAAAA= b')
+
+    def test_parse_matches_reference(self):
+        for line in fuzzed_corpus(5000):
+            try:
+                e = claviger.authorized_keys.Entry.parse(line)
+                got = (e.options, e.keytype, e.key, e.comment)
+                self.assertEqual(e.raw_line, line)
+            except claviger.authorized_keys.CouldNotParseLine:
+                got = None
+            self.assertEqual(got, reference_parse(line), repr(line))
+
 if __name__ == '__main__':
     unittest.main()
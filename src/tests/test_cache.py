@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import claviger.cache
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.tempdir
+
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.tempdir)
+
+    def test_update_failed_servers(self):
+        self.assertEqual(claviger.cache.load_failed_servers(), None)
+        claviger.cache.update_failed_servers(['a', 'b', 'c'], ['a', 'b'])
+        self.assertEqual(claviger.cache.load_failed_servers(), ['a', 'b'])
+        # A run limited to b and c keeps the failure of a
+        claviger.cache.update_failed_servers(['b', 'c'], ['c'])
+        self.assertEqual(claviger.cache.load_failed_servers(), ['a', 'c'])
+        claviger.cache.update_failed_servers(['a', 'b', 'c'], [])
+        self.assertEqual(claviger.cache.load_failed_servers(), [])
+
+if __name__ == '__main__':
+    unittest.main()
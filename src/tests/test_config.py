@@ -0,0 +1,170 @@
+import os
+import time
+import shutil
+import os.path
+import tempfile
+import textwrap
+import unittest
+
+import claviger.config
+
+EXAMPLE_CONFIG = textwrap.dedent("""
+    keys:
+        laptop: ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAINYZEwjtu8w9Hsvx85TlYE95MLV9Whc3N1ajrH7+gu7A
+        work: ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICrycv44eyFwWJ7QQsGOnjEiAsFSdxIoAEzBPSO/AQB5 work
+    servers:
+        $default:
+            present:
+                - laptop
+        myprivateserver.com:
+        root@myotherserver.com:2222:
+            present:
+                - work
+            absent:
+                - laptop
+    """)
+
+def stanza(**kwargs):
+    """ Returns a server stanza as it is before inheritance is resolved. """
+    ret = {'port': None, 'user': None, 'hostname': None, 'ssh_user': None,
+           'keepOtherKeys': None, 'group': None, 'groupConnections': None,
+           'present': [], 'absent': [], 'allow': [], 'like': None}
+    ret.update(kwargs)
+    return ret
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tempdir, 'cache')
+        self.path = os.path.join(self.tempdir, 'claviger.yml')
+        self.write_config(EXAMPLE_CONFIG)
+
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.tempdir)
+
+    def write_config(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def test_load(self):
+        cfg = claviger.config.load(self.path, use_cache=False)
+        server = cfg['servers']['root@myotherserver.com:2222']
+        self.assertEqual(server['hostname'], 'myotherserver.com')
+        self.assertEqual(server['port'], 2222)
+        self.assertEqual(server['present'], ['work'])
+        self.assertEqual(server['absent'], ['laptop'])
+        server = cfg['servers']['myprivateserver.com']
+        self.assertEqual(server['present'], ['laptop'])
+        self.assertEqual(server['user'], 'root')
+        self.assertEqual(server['users'], ['root'])
+        self.assertEqual(server['ssh_user'], 'root')
+
+    def test_users(self):
+        self.write_config(EXAMPLE_CONFIG.replace('servers:', 'servers:\n'
+                    '    deploy.com:\n'
+                    '        user: [deploy, backup]\n'
+                    '    bas@shared.com:\n'
+                    '        ssh_user: root\n'))
+        cfg = claviger.config.load(self.path, use_cache=False)
+        server = cfg['servers']['deploy.com']
+        self.assertEqual(server['users'], ['deploy', 'backup'])
+        self.assertEqual(server['user'], 'deploy')
+        self.assertEqual(server['ssh_user'], 'deploy')
+        server = cfg['servers']['bas@shared.com']
+        self.assertEqual(server['users'], ['bas'])
+        self.assertEqual(server['ssh_user'], 'root')
+
+    def test_compiled_cache(self):
+        cfg = claviger.config.load(self.path)
+        self.assertEqual(claviger.config.load(self.path), cfg)
+        self.assertEqual(claviger.config.load(self.path, use_cache=False), cfg)
+
+        self.write_config(EXAMPLE_CONFIG.replace('2222', '2223'))
+        cfg = claviger.config.load(self.path)
+        self.assertIn('root@myotherserver.com:2223', cfg['servers'])
+
+    def test_snapshot(self):
+        self.write_config(EXAMPLE_CONFIG + '    $work:\n'
+                          '        present: [work]\n'
+                          '    workserver.com:\n'
+                          '        like: $work\n')
+        def digests():
+            cfg = claviger.config.load(self.path)
+            return {server_name: claviger.config.server_digest(server,
+                                                               cfg['keys'])
+                        for server_name, server in cfg['servers'].items()
+                        if not server['abstract']}
+        snapshot_path = os.path.join(self.tempdir, 'snapshot.json')
+        self.assertIsNone(claviger.config.load_snapshot(snapshot_path))
+        claviger.config.write_snapshot(snapshot_path, digests())
+        snapshot = claviger.config.load_snapshot(snapshot_path)
+        self.assertEqual(snapshot, digests())
+
+        # Changing an abstract stanza changes the servers that inherit
+        # from it and only those.
+        with open(self.path) as f:
+            contents = f.read()
+        self.write_config(contents.replace('present: [work]',
+                                'present: [work]\n        allow: [laptop]'))
+        self.assertEqual([server_name
+                            for server_name, digest in digests().items()
+                            if snapshot[server_name] != digest],
+                         ['workserver.com'])
+
+    def test_snapshot_in_current_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        try:
+            claviger.config.write_snapshot('snapshot.json',
+                                           {'myprivateserver.com': 'x'})
+            self.assertEqual(claviger.config.load_snapshot('snapshot.json'),
+                             {'myprivateserver.com': 'x'})
+            self.assertEqual(sorted(os.listdir(self.tempdir)),
+                             ['claviger.yml', 'snapshot.json'])
+        finally:
+            os.chdir(cwd)
+
+    def test_patterns(self):
+        # Keys that are not referred to by the servers are not parsed.
+        self.write_config(EXAMPLE_CONFIG.replace('servers:',
+                                '    broken: not a key\nservers:'))
+        cfg = claviger.config.load(self.path, patterns=['myprivate*'])
+        self.assertEqual(sorted(cfg['servers']),
+                         ['$default', 'myprivateserver.com'])
+        self.assertEqual(sorted(cfg['keys']), ['laptop'])
+        self.assertEqual(cfg['servers']['myprivateserver.com']['present'],
+                         ['laptop'])
+        self.assertTrue(claviger.config.matches('myprivateserver.com',
+                                                ['web*', 'my*.com']))
+
+    def test_inheritance_scales(self):
+        # 10k servers inherit 1k keys through $default -> $team -> server.
+        # Inheriting used to take time quadratic in the number of keys,
+        # which would take minutes here.
+        keys = ['key{0}'.format(i) for i in range(1000)]
+        servers = {'$default': stanza(present=keys[:900], port=2222),
+                   '$team': stanza(like='$default', absent=keys[900:],
+                                   allow=keys[:10], user='admin')}
+        for i in range(10000):
+            servers['host{0}'.format(i)] = stanza(like='$team',
+                        present=[keys[900 + i % 100]],
+                        absent=[keys[i % 900]])
+        start = time.time()
+        claviger.config.resolve_inheritance(servers)
+        self.assertLess(time.time() - start, 30)
+
+        server = servers['host1']
+        self.assertEqual(server['present'],
+                         [keys[901]] + keys[:1] + keys[2:900])
+        self.assertEqual(server['absent'],
+                         [keys[1]] + keys[900:901] + keys[902:])
+        self.assertEqual(server['allow'], keys[:1] + keys[2:10])
+        self.assertEqual((server['port'], server['user']), (2222, 'admin'))
+
+if __name__ == '__main__':
+    unittest.main()
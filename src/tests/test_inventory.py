@@ -0,0 +1,49 @@
+import shutil
+import os.path
+import tempfile
+import unittest
+
+import claviger.worker
+import claviger.inventory
+import claviger.authorized_keys
+
+AUTHORIZED_KEYS = (b'ssh-rsa AAAAB3NzaC1yc2EAAAA= user@example.net\n'
+                   b'no-pty ssh-dss AAAAB3NzaC1kc3MAAA==\n')
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'inventory.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_inventory(self):
+        entries = claviger.worker.inventory_entries('root',
+                        claviger.authorized_keys.parse(AUTHORIZED_KEYS))
+        fingerprint = claviger.authorized_keys.fingerprint(
+                                                b'AAAAB3NzaC1yc2EAAAA=')
+        self.assertEqual(entries[0], ('root', fingerprint, 'ssh-rsa',
+                                      'user@example.net', None))
+        self.assertEqual(entries[1][4], 'no-pty')
+
+        inventory = claviger.inventory.Inventory(self.path)
+        inventory.record('a', 'digest-a', entries)
+        inventory.record('b', None, entries[:1])
+        inventory.close()
+
+        inventory = claviger.inventory.Inventory(self.path)
+        self.assertEqual(inventory.digest('a'), 'digest-a')
+        self.assertIsNone(inventory.digest('b'))
+        self.assertIsNone(inventory.digest('c'))
+        self.assertEqual(inventory.find(fingerprint),
+                         [('a', 'root', 'user@example.net'),
+                          ('b', 'root', 'user@example.net')])
+        inventory.record('a', 'digest-a2', entries[1:])
+        inventory.prune(['a'])
+        self.assertEqual(inventory.find(fingerprint), [])
+        self.assertEqual(len(inventory.find(entries[1][1])), 1)
+        inventory.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import unittest
+
+import six
+
+import claviger.scp
+import claviger.report
+import claviger.worker
+
+def job_return(server_name, added=0, removed=0, error=None):
+    if error is not None:
+        return claviger.worker.JobReturn(server_name=server_name, ok=False,
+                                         result=error, duration=1.0,
+                                         timings={'error': 1.0})
+    changes = []
+    if added or removed:
+        changes.append(('root', ['key'] * added, ['old'] * removed))
+    return claviger.worker.JobReturn(server_name=server_name, ok=True,
+                    result=claviger.worker.JobResult(n_keys_added=added,
+                                    n_keys_removed=removed, n_keys_ignored=0,
+                                    remote_digest=None, diff=None,
+                                    paths={}, changes=changes, entries=None),
+                    duration=1.0, timings={'get': 1.0})
+
+class TestReport(unittest.TestCase):
+    def test_json(self):
+        out = six.StringIO()
+        reporter = claviger.report.JSONReporter(dry_run=True, out=out)
+        reporter.report(job_return('a', added=1))
+        reporter.report(job_return('b'))
+        reporter.report(job_return('c',
+                    error=claviger.scp.HostKeyVerificationFailed()))
+        reporter.finish()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['status'] for e in events],
+                         ['changed', 'ok', 'hostkey', 'errors'])
+        self.assertEqual(events[-1]['changed'], ['a'])
+        self.assertEqual(events[-1]['failed'], ['c'])
+        self.assertEqual(events[-1]['n_servers'], 3)
+
+    def test_text(self):
+        out = six.StringIO()
+        reporter = claviger.report.TextReporter(dry_run=False, out=out)
+        reporter.report(job_return('a'))
+        reporter.finish()
+        self.assertEqual(out.getvalue(), 'Everything is in order.\n')
+
+    def test_summary(self):
+        out = six.StringIO()
+        reporter = claviger.report.JSONReporter(dry_run=True, out=out,
+                                                summary=True)
+        for server_name in ('a', 'b', 'c'):
+            reporter.report(job_return(server_name, added=1))
+        reporter.report(job_return('d', removed=1))
+        reporter.report(job_return('e'))
+        reporter.finish()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ['server', 'changes', 'changes', 'summary'])
+        self.assertEqual(events[1]['servers'], ['a', 'b', 'c'])
+        self.assertEqual(events[1]['changes'], [{'user': 'root',
+                            'added': ['key'], 'removed': []}])
+        self.assertEqual(events[2]['servers'], ['d'])
+
+        out = six.StringIO()
+        reporter = claviger.report.TextReporter(dry_run=True, out=out,
+                                                summary=True)
+        reporter.report(job_return('a', added=1))
+        reporter.report(job_return('b', added=1))
+        reporter.finish()
+        self.assertIn('2 servers:\n  root: + key\n    a b\n',
+                      out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+import claviger.schedule
+import claviger.worker
+
+def group_of(job):
+    return job[0], {'a': 2, 'b': 1}.get(job[0])
+
+class TestSchedule(unittest.TestCase):
+    def test_limits(self):
+        jobs = [('a', i) for i in range(4)] + [('b', i) for i in range(2)] \
+                    + [(None, i) for i in range(3)]
+        scheduler = claviger.schedule.Scheduler(jobs, group_of)
+        started = []
+        while True:
+            job = scheduler.next()
+            if job is None:
+                break
+            started.append(job)
+        # Groups are interleaved and a and b stop at their limit.
+        self.assertEqual(started, [('a', 0), ('b', 0), (None, 0), ('a', 1),
+                                   (None, 1), (None, 2)])
+        scheduler.done(('b', 0))
+        self.assertEqual(scheduler.next(), ('b', 1))
+        self.assertEqual(scheduler.next(), None)
+        scheduler.done(('a', 1))
+        self.assertEqual(scheduler.next(), ('a', 2))
+        self.assertEqual(scheduler.n_pending, 1)
+
+    def test_lookahead(self):
+        taken = []
+        def jobs():
+            for i in range(10):
+                taken.append(i)
+                yield (None, i)
+        scheduler = claviger.schedule.Scheduler(jobs(), group_of,
+                                                lookahead=3)
+        self.assertEqual(scheduler.next(), (None, 0))
+        self.assertEqual(taken, [0, 1, 2])
+        self.assertEqual(scheduler.next(), (None, 1))
+        self.assertEqual(taken, [0, 1, 2, 3])
+        self.assertEqual(scheduler.n_pending, 2)
+
+    def test_blocked_group(self):
+        # The jobs of a group at its limit do not hold up the jobs after
+        # them, however many there are.
+        jobs = [('a', i) for i in range(300)] + [(None, i) for i in range(100)]
+        scheduler = claviger.schedule.Scheduler(iter(jobs), group_of,
+                                                lookahead=10)
+        started = [scheduler.next() for _ in range(50)]
+        self.assertEqual(started, [('a', 0), ('a', 1)]
+                                    + [(None, i) for i in range(48)])
+        scheduler.done(('a', 0))
+        self.assertEqual(scheduler.next(), ('a', 2))
+        self.assertEqual(scheduler.next(), (None, 48))
+
+    def test_server_group(self):
+        job = claviger.worker.Job(server={'group': None,
+                                          'groupConnections': 2},
+                                  policy=None, dry_run=True, no_diff=True,
+                                  cached=None, paths={}, inventory=False)
+        self.assertEqual(claviger.schedule.server_group(job), (None, None))
+        job.server['group'] = 'rack1'
+        self.assertEqual(claviger.schedule.server_group(job), ('rack1', 2))
+
+    def test_run_sequentially(self):
+        scheduler = claviger.schedule.Scheduler(
+                        [('a', i) for i in range(5)], group_of)
+        self.assertEqual(list(claviger.schedule.run_sequentially(
+                            lambda job: job[1], scheduler)), list(range(5)))
+
+    def test_shard(self):
+        jobs = [('a', i) for i in range(4)] + [('b', i) for i in range(2)] \
+                    + [(None, i) for i in range(3)]
+        shards = claviger.schedule.shard(jobs, 3, group_of)
+        self.assertEqual(sorted(map(len, shards)), [2, 3, 4])
+        # The jobs of a group with a limit stay together, in order.
+        self.assertIn([('a', i) for i in range(4)], shards)
+        self.assertEqual(sorted(sum(shards, []), key=repr),
+                         sorted(jobs, key=repr))
+        self.assertEqual(claviger.schedule.shard([], 2, group_of), [[], []])
+
+if __name__ == '__main__':
+    unittest.main()
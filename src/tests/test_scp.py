@@ -0,0 +1,295 @@
+import os
+import time
+import shutil
+import os.path
+import tempfile
+import unittest
+import subprocess
+
+import six
+
+import claviger.authorized_keys
+import claviger.scp
+import claviger.worker
+
+# Stand-ins for scp and ssh, that run on the local machine.  scp strips
+# the host from its arguments and copies, or prints its usage, which is
+# CLAVIGER_TEST_SCP_USAGE if set, when it is not given files; ssh runs the
+# remote command,
+# after CLAVIGER_TEST_SSH_PREFIX, unless it is told to print
+# CLAVIGER_TEST_SSH_OUTPUT instead.  Both log their arguments, except for
+# the remote command.
+FAKE_SCP = """#!/bin/sh
+if [ $# -eq 1 ]; then
+    echo "${CLAVIGER_TEST_SCP_USAGE:-usage: scp [-346ABCOpqRrsTv] src trg}" >&2
+    exit 1
+fi
+echo scp "$@" >> "$CLAVIGER_TEST_LOG"
+for a; do src="$trg"; trg="$a"; done
+exec cp "${src#*:}" "${trg#*:}"
+"""
+FAKE_SSH = """#!/bin/sh
+case " $* " in *" -O "*) echo ssh "$@" >> "$CLAVIGER_TEST_LOG"; exit 0;; esac
+if [ -n "$CLAVIGER_TEST_SSH_OUTPUT" ]; then
+    printf '%s' "$CLAVIGER_TEST_SSH_OUTPUT"
+    exit 0
+fi
+for a; do cmd="$a"; done
+exec sh -c "$CLAVIGER_TEST_SSH_PREFIX$cmd"
+"""
+
+class FakeBinTestCase(unittest.TestCase):
+    """ Puts the fake scp and ssh in front of PATH. """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.mkdir(bindir)
+        for name, script in (('scp', FAKE_SCP), ('ssh', FAKE_SSH)):
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        self.log = os.path.join(self.tempdir, 'log')
+        self.old_environ = dict(os.environ)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['CLAVIGER_TEST_LOG'] = self.log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tempdir)
+
+    def logged(self):
+        """ Returns the arguments of the logged calls to scp and ssh. """
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [line.split() for line in f]
+
+    def authorized_keys(self, contents):
+        """ Writes contents to an authorized_keys file and returns its
+            path. """
+        path = os.path.join(self.tempdir, 'authorized_keys')
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+EMPTY_SERVER = {'name': 'example.com', 'hostname': 'example.com',
+                'port': 22, 'user': 'root', 'users': ['root'],
+                'ssh_user': 'root',
+                'present': [], 'absent': [], 'allow': [],
+                'keepOtherKeys': True}
+
+class FlakySCP(claviger.scp.SCP):
+    """ Creates sessions that drop the connection the first n_failures
+        times. """
+    def __init__(self, n_failures, **kwargs):
+        super(FlakySCP, self).__init__(multiplex=False, **kwargs)
+        self.n_failures = n_failures
+        self.n_attempts = 0
+    def connect(self, hostname, port, ssh_user):
+        return FlakySession(hostname, port, ssh_user, self)
+
+class FlakySession(claviger.scp.SCPSession):
+    def get(self, user):
+        self.scp.n_attempts += 1
+        if self.scp.n_attempts <= self.scp.n_failures:
+            raise claviger.scp.interpret_scp_error(255,
+                    'ssh_exchange_identification: read: '
+                    'Connection reset by peer\n', '')
+        return b''
+
+class TestSCP(FakeBinTestCase):
+    def test_multiplex(self):
+        path = self.authorized_keys(b'old\n')
+        scp = claviger.scp.SCP()
+        session = scp.connect('example.com', 2222, 'root')
+        session._path_for = lambda user: path
+        self.assertEqual(session.get('root'), b'old\n')
+        session.put('root', b'new\n')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new\n')
+        calls = self.logged()
+        self.assertEqual([call[0] for call in calls], ['scp', 'scp'])
+        # Both copies go over the same master connection.
+        control_paths = set()
+        for call in calls:
+            self.assertEqual(call[call.index('-P') + 1], '2222')
+            self.assertIn('ControlMaster=auto', call)
+            control_paths.update(arg for arg in call
+                                    if arg.startswith('ControlPath='))
+        self.assertEqual(len(control_paths), 1)
+        control_path = control_paths.pop()
+        control_dir = os.path.dirname(control_path[len('ControlPath='):])
+        self.assertTrue(os.path.isdir(control_dir))
+
+        scp.close()
+        self.assertEqual(self.logged()[-1],
+                         ['ssh', '-o', control_path, '-O', 'exit',
+                          '-p', '2222', 'root@example.com'])
+        self.assertFalse(os.path.exists(control_dir))
+
+    def test_no_multiplex(self):
+        path = self.authorized_keys(b'old\n')
+        scp = claviger.scp.SCP(multiplex=False)
+        session = scp.connect('example.com', 22, 'root')
+        session._path_for = lambda user: path
+        self.assertEqual(session.get('root'), b'old\n')
+        scp.close()
+        calls = self.logged()
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(any(arg.startswith('Control') for arg in calls[0]))
+
+    def test_interpret_scp_error(self):
+        self.assertIsInstance(claviger.scp.interpret_scp_error(1,
+                    'Host key verification failed.\n', ''),
+                claviger.scp.HostKeyVerificationFailed)
+        self.assertIsInstance(claviger.scp.interpret_scp_error(255,
+                    'ssh: connect to host example.com port 22: '
+                    'Connection timed out\n', ''),
+                claviger.scp.TransientSCPError)
+        e = claviger.scp.interpret_scp_error(255,
+                    'Permission denied (publickey).\n', '')
+        self.assertNotIsInstance(e, claviger.scp.TransientSCPError)
+
+    def test_parse_discovery(self):
+        parse = claviger.scp.parse_discovery
+        self.assertEqual(parse('/home/bas\n1000\n\n', 'bas'),
+                         '/home/bas/.ssh/authorized_keys')
+        self.assertEqual(parse('/home/bas\n1000\n'
+                               ' /etc/ssh/keys/%u-%U%% .ssh/authorized_keys\n',
+                               'bas'),
+                         '/etc/ssh/keys/bas-1000%')
+        self.assertEqual(parse('/home/bas\n1000\n%h/keys\n', 'bas'),
+                         '/home/bas/keys')
+        self.assertIsNone(parse('\n\n\n', 'bas'))
+        with self.assertRaises(claviger.scp.SCPError):
+            parse('/home/bas\n1000\nnone\n', 'bas')
+
+    def test_scp_cmd(self):
+        session = claviger.scp.SCPSession('example.com', 22, 'root',
+                    claviger.scp.SCP(multiplex=False))
+        session.paths['root'] = '/etc/ssh/keys/root keys'
+        cmd = session._scp_cmd(session._remote_path('root'), '/tmp/root')
+        # The path is quoted for the remote shell, so scp must not use SFTP.
+        self.assertIn('-O', cmd)
+        self.assertEqual(cmd[-2], "root@example.com:'/etc/ssh/keys/root keys'")
+        # scp before OpenSSH 8.7 does not know -O, but does not use SFTP.
+        os.environ['CLAVIGER_TEST_SCP_USAGE'] = \
+                'usage: scp [-346BCpqrv] [-c cipher] src trg'
+        session.scp = claviger.scp.SCP(multiplex=False)
+        cmd = session._scp_cmd(session._remote_path('root'), '/tmp/root')
+        self.assertNotIn('-O', cmd)
+
+    def test_timeout(self):
+        session = claviger.scp.SCPSession('example.com', 22, 'root',
+                    claviger.scp.SCP(multiplex=False, timeout=0.1))
+        start = time.time()
+        with self.assertRaises(claviger.scp.SCPTimeout):
+            session._run(['sleep', '10'])
+        self.assertLess(time.time() - start, 5)
+
+    def test_retry(self):
+        job = claviger.worker.Job(server=EMPTY_SERVER,
+                    policy=claviger.authorized_keys.make_policy(()),
+                    dry_run=True, no_diff=False, cached=None,
+                    paths={'root': '/root/.ssh/authorized_keys'},
+                    inventory=False)
+        scp = FlakySCP(2, retries=2, backoff=0.001)
+        ret = claviger.worker.check_server(job, scp)
+        self.assertTrue(ret.ok)
+        self.assertEqual(scp.n_attempts, 3)
+        self.assertIn('backoff', ret.timings)
+
+        scp = FlakySCP(2, retries=1, backoff=0.001)
+        ret = claviger.worker.check_server(job, scp)
+        self.assertFalse(ret.ok)
+        self.assertIsInstance(ret.result, claviger.scp.TransientSCPError)
+
+    def test_ssh_script(self):
+        # Runs the script of SSHSession locally on two files, of which
+        # only the second is replaced.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tmpdir, name) for name in ('a', 'b')]
+            for path, contents in zip(paths, (b'first\n', b'second\n')):
+                with open(path, 'wb') as f:
+                    f.write(contents)
+            script = claviger.scp._SSH_SCRIPT.format(paths=' '.join(
+                            six.moves.shlex_quote(path) for path in paths))
+            session = claviger.scp.SSHSession('example.com', 22, 'root')
+            p = subprocess.Popen(['sh', '-c', script], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+            stdout = p.communicate(session._put_cmd(
+                                            [None, b'new\ncontents\n']))[0]
+            self.assertEqual(p.returncode, 0)
+            self.assertEqual(stdout, b'6\nfirst\n7\nsecond\n')
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(f.read(), b'first\n')
+            with open(paths[1], 'rb') as f:
+                self.assertEqual(f.read(), b'new\ncontents\n')
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['a', 'b'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestSSHSession(FakeBinTestCase):
+    def session(self, path, timeout=None):
+        session = claviger.scp.SSHSession('example.com', 22, 'root',
+                        claviger.scp.SCP(multiplex=False, timeout=timeout))
+        session._path_for = lambda user: path
+        return session
+
+    def test_round_trip(self):
+        path = self.authorized_keys(b'old\n')
+        session = self.session(path)
+        self.assertEqual(session.get('root'), b'old\n')
+        session.put('root', b'new\ncontents\n')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new\ncontents\n')
+        # The copy that was renamed over the file is gone.
+        self.assertFalse([name for name in os.listdir(self.tempdir)
+                                if '.claviger.' in name])
+        # Without a put, the file is kept as it is.
+        session = self.session(path)
+        self.assertEqual(session.get('root'), b'new\ncontents\n')
+        session.close()
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new\ncontents\n')
+
+    def test_missing_file(self):
+        session = self.session(os.path.join(self.tempdir, 'missing'))
+        with self.assertRaises(claviger.scp.SCPError):
+            session.get('root')
+
+    def test_short_read(self):
+        os.environ['CLAVIGER_TEST_SSH_OUTPUT'] = '100\nold\n'
+        session = self.session(self.authorized_keys(b'old\n'))
+        with six.assertRaisesRegex(self, claviger.scp.SCPError,
+                                   '^ssh: unexpected output'):
+            session.get('root')
+
+    def test_stderr(self):
+        # More on stderr than fits in a pipe must not block ssh.
+        os.environ['CLAVIGER_TEST_SSH_PREFIX'] = \
+                'head -c 1000000 /dev/zero >&2; '
+        session = self.session(self.authorized_keys(b'old\n'), timeout=10)
+        self.assertEqual(session.get('root'), b'old\n')
+        session.close()
+
+    def test_unexpected_output(self):
+        # The error of the script, which fails when stdin is closed, does
+        # not hide that its output was not what we expected ...
+        os.environ['CLAVIGER_TEST_SSH_PREFIX'] = \
+                'echo Welcome; cat > /dev/null; exit 1; '
+        session = self.session(self.authorized_keys(b'old\n'))
+        with six.assertRaisesRegex(self, claviger.scp.SCPError,
+                                   '^ssh: unexpected output'):
+            session.get('root')
+        # ... but a failure of ssh itself, which explains it, is raised.
+        os.environ['CLAVIGER_TEST_SSH_PREFIX'] = \
+                'echo kex_exchange_identification >&2; exit 255; '
+        with self.assertRaises(claviger.scp.TransientSCPError):
+            session.get('root')
+
+if __name__ == '__main__':
+    unittest.main()
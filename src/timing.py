@@ -0,0 +1,93 @@
+""" Measures where claviger spends its time. """
+import time
+import math
+import collections
+
+class Stopwatch(object):
+    """ Measures the time spent in consecutive phases of some work.
+
+        Call lap(phase) at the end of every phase. """
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self._last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self._last
+        self._last = now
+
+    def total(self):
+        return sum(self.timings.values())
+
+def percentile(sorted_values, p):
+    """ Returns the p-th percentile (nearest rank) of a sorted list. """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+class Profile(object):
+    """ Collects the timings of loading the configuration and of checking
+        every server. """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.config_timings = {}
+        self.server_timings = {}
+        self.server_durations = {}
+
+    def add(self, ret):
+        """ Adds the timings of a claviger.worker.JobReturn """
+        self.server_timings[ret.server_name] = ret.timings
+        self.server_durations[ret.server_name] = ret.duration
+
+    def phases(self):
+        """ Returns the percentiles of the durations of every phase of
+            checking a server. """
+        values = collections.OrderedDict()
+        for timings in self.server_timings.values():
+            for phase, duration in timings.items():
+                values.setdefault(phase, []).append(duration)
+        if self.server_durations:
+            values['total'] = list(self.server_durations.values())
+        ret = collections.OrderedDict()
+        for phase, durations in values.items():
+            durations.sort()
+            stats = collections.OrderedDict(
+                        ('p{0}'.format(p), percentile(durations, p))
+                            for p in self.PERCENTILES)
+            stats['max'] = durations[-1] if durations else None
+            stats['count'] = len(durations)
+            ret[phase] = stats
+        return ret
+
+    def slowest(self, n):
+        """ Returns the n slowest servers as (name, duration) pairs. """
+        return sorted(self.server_durations.items(),
+                      key=lambda x: x[1], reverse=True)[:n]
+
+    def as_dict(self, n_slowest):
+        return {'config': self.config_timings,
+                'phases': self.phases(),
+                'slowest': self.slowest(n_slowest)}
+
+    def write(self, out, n_slowest):
+        """ Writes a human readable report to out """
+        out.write('\nLoading configuration\n')
+        for phase, duration in self.config_timings.items():
+            out.write('  {0:<16} {1:9.1f} ms\n'.format(phase, duration * 1000))
+        out.write('\nChecking servers (ms)\n')
+        out.write('  {0:<16}'.format('phase'))
+        for p in self.PERCENTILES:
+            out.write(' {0:>9}'.format('p{0}'.format(p)))
+        out.write(' {0:>9} {1:>7}\n'.format('max', 'count'))
+        for phase, stats in self.phases().items():
+            out.write('  {0:<16}'.format(phase))
+            for p in self.PERCENTILES:
+                out.write(' {0:9.1f}'.format(
+                            stats['p{0}'.format(p)] * 1000))
+            out.write(' {0:9.1f} {1:>7}\n'.format(stats['max'] * 1000,
+                                                  stats['count']))
+        out.write('\nSlowest servers\n')
+        for name, duration in self.slowest(n_slowest):
+            out.write('  {0:<40} {1:9.1f} ms\n'.format(name, duration * 1000))
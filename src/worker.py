@@ -5,89 +5,239 @@
     environment in this module  with the rest of the program. """
 
 import sys
+import time
 import difflib
+import hashlib
 import traceback
 import collections
 
 import six
 
 import claviger.scp
+import claviger.timing
 import claviger.authorized_keys
 
 # arguments send by the main process
 Job = collections.namedtuple('Job',
-                ('server', 'keys', 'dry_run', 'no_diff'))
+                ('server', 'policy', 'dry_run', 'no_diff', 'cached', 'paths',
+                 'inventory'))
+# policy is the claviger.authorized_keys.Policy of the server, which is
+# shared with the servers that have the same present, absent, allow and
+# keepOtherKeys.  If inventory is set, the keys on the server are returned
+# in JobResult.entries.
+# paths maps the users of the server to the paths of their authorized_keys
+# files, as far as they are known from a previous run.
+# the cached field is None or contains the state of the server from the
+# last run (if its configuration did not change since) as follows.
+CachedState = collections.namedtuple('CachedState',
+                ('remote_digest', 'n_keys_ignored'))
 
 # this is what we return
 JobReturn = collections.namedtuple('JobReturn',
-                ('server_name', 'ok', 'result'))
+                ('server_name', 'ok', 'result', 'duration', 'timings'))
+# timings maps the phases of the check (like 'get' and 'parse') to the time
+# spent in them.
 # if everything is ok, the result field is of the following type ...
 JobResult = collections.namedtuple('JobResult',
-                ('n_keys_added', 'n_keys_removed', 'n_keys_ignored'))
+                ('n_keys_added', 'n_keys_removed', 'n_keys_ignored',
+                 'remote_digest', 'diff', 'paths', 'changes', 'entries'))
+# remote_digest is the SHA-256 of the authorized_keys file on the server
+# (see combine_digests if there are several users), if it is in order after
+# this run, and None otherwise.  diff is the unified diff of the changes,
+# if they were not made because of a dry run.  paths maps the users to the
+# paths of their authorized_keys files, as far as they could be determined.
+# changes is a list with a triple (user, added, removed) for every user
+# whose file (should) change, where added and removed are sorted lists of
+# the labels (see key_label) of the keys.  entries is None, unless
+# Job.inventory is set and the files were fetched: then it lists the
+# entries (see inventory_entries) that are on the server after this run.
 # ... otherwise it is an exception
 
-def check_server(job):
-    try:
+def check_server(job, scp=None):
+    """ Checks (and fixes) the authorized_keys on the server described
+        by job.  Connections are made using scp, which defaults to a fresh
+        claviger.scp.SCP that is closed afterwards.  Transient failures
+        are retried as scp.retry_delay prescribes. """
+    own_scp = scp is None
+    if own_scp:
         scp = claviger.scp.SCP()
-        n_keys_removed = 0
-        n_keys_added = 0
-        n_keys_ignored = 0
-        server = job.server
-        conn = scp.connect(server['hostname'], server['port'],
-                                    server['ssh_user'])
-
-        # First pull the current authorized_keys
-        original_raw_ak = conn.get(server['user'])
-        ak = claviger.authorized_keys.parse(original_raw_ak)
-
-        # Check which keys to add
-        for key_name in server['present']:
-            key = job.keys[key_name]
-            # TODO update comment/options
-            if ak.contains(key['key']):
-                continue
-            n_keys_added += 1
-            ak.add(key['options'], key['keytype'], key['key'], key['comment'])
-
-        # Check which keys to remove
-        if server['keepOtherKeys']:
-            for key_name in server['absent']:
-                if not ak.contains(job.keys[key_name]['key']):
-                    continue
-                ak.remove(job.keys[key_name]['key'])
-                n_keys_removed += 1
-        allowed = {job.keys[key_name]['key']
-                        for key_name in server['present'] + server['allow']}
-
-        for entry in ak.entries:
-            if entry.key in allowed:
-                continue
-            if not server['keepOtherKeys']:
-                ak.remove(entry.key)
-                n_keys_removed += 1
-            else:
-                n_keys_ignored += 1
-
-        # Did things change?
-        raw_ak = six.binary_type(ak)
-        if n_keys_added or n_keys_removed:
-            if job.dry_run:
-                if not job.no_diff:
-                    print(''.join(difflib.unified_diff(
-                                original_raw_ak.decode('utf-8').splitlines(True),
-                                raw_ak.decode('utf-8').splitlines(True),
-                                server['name'])))
-            else:
-                conn.put(server['user'], raw_ak)
-
-        return JobReturn(server_name=server['name'], ok=True,
-                    result=JobResult(n_keys_added=n_keys_added,
-                                     n_keys_removed=n_keys_removed,
-                                     n_keys_ignored=n_keys_ignored))
+    server = job.server
+    stopwatch = claviger.timing.Stopwatch()
+    def job_return(ok, result):
+        return JobReturn(server_name=server['name'], ok=ok, result=result,
+                         duration=stopwatch.total(),
+                         timings=stopwatch.timings)
+    try:
+        attempt = 0
+        while True:
+            try:
+                return job_return(True, _check_server(job, scp, stopwatch))
+            except claviger.scp.TransientSCPError as e:
+                stopwatch.lap('error')
+                attempt += 1
+                delay = scp.retry_delay(attempt)
+                if delay is None:
+                    return job_return(False, e)
+                time.sleep(delay)
+                stopwatch.lap('backoff')
     except claviger.scp.SCPError as e:
-        return JobReturn(server_name=server['name'], ok=False, result=e)
+        stopwatch.lap('error')
+        return job_return(False, e)
     except Exception as e:
         # multiprocessing does not pass the stacktrace to the parent process.
         #   ( see http://stackoverflow.com/questions/6126007 )
         # Thus we force the stacktrace in the message.
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        if own_scp:
+            scp.close()
+
+def _check_server(job, scp, stopwatch):
+    """ Makes a single attempt at check_server and returns the JobResult. """
+    server = job.server
+    users = server['users']
+    conn = scp.connect(server['hostname'], server['port'],
+                                server['ssh_user'])
+    try:
+        paths = {}
+        for user in users:
+            if job.paths.get(user) is None:
+                paths[user] = conn.discover(user)
+                stopwatch.lap('discover')
+            else:
+                paths[user] = conn.paths[user] = job.paths[user]
+        if job.cached is not None:
+            # Checking the digest is cheaper than fetching the files.
+            remote_digest = combine_digests([conn.digest(user)
+                                                for user in users])
+            stopwatch.lap('digest')
+            if remote_digest == job.cached.remote_digest:
+                return cached_result(job)._replace(paths=paths)
+        original_raw_aks = conn.get_many(users)
+        stopwatch.lap('get')
+        raw_aks, result = update_authorized_keys(job, original_raw_aks,
+                                                 stopwatch)
+        if any(raw_ak is not None for raw_ak in raw_aks):
+            conn.put_many(users, raw_aks)
+            stopwatch.lap('put')
+    finally:
+        conn.close()
+        stopwatch.lap('close')
+    return result._replace(paths=paths)
+
+def combine_digests(digests):
+    """ Returns the digest of a server from the SHA-256 digests of the
+        authorized_keys files of its users.  For a single user, it is
+        the digest of the file itself. """
+    if len(digests) == 1:
+        return digests[0]
+    return hashlib.sha256(' '.join(digests).encode('utf-8')).hexdigest()
+
+def cached_result(job):
+    """ Returns the result for a server that did not change since the
+        last run. """
+    return JobResult(n_keys_added=0,
+                     n_keys_removed=0,
+                     n_keys_ignored=job.cached.n_keys_ignored,
+                     remote_digest=job.cached.remote_digest,
+                     diff=None,
+                     paths=job.paths,
+                     changes=[],
+                     entries=None)
+
+def update_authorized_keys(job, original_raw_aks, stopwatch=None):
+    """ Computes the new authorized_keys files for the users of the server
+        of job, whose current files are original_raw_aks.
+
+        Returns a pair (raw_aks, result), where raw_aks is the list of the
+        new files: one per user, which is None if the file of the user
+        should not be written back to the server.  The time spent is
+        recorded on stopwatch, if given. """
+    if stopwatch is None:
+        stopwatch = claviger.timing.Stopwatch()
+    server = job.server
+
+    raw_aks = []
+    digests = []
+    diffs = []
+    changes = []
+    entries = [] if job.inventory else None
+    n_keys_added = n_keys_removed = n_keys_ignored = 0
+    for user, original_raw_ak in zip(server['users'], original_raw_aks):
+        ak = claviger.authorized_keys.parse(original_raw_ak)
+        stopwatch.lap('parse')
+        # TODO update comment/options
+        plan = claviger.authorized_keys.enforce(ak, job.policy)
+        stopwatch.lap('reconcile')
+        n_keys_added += len(plan.added)
+        n_keys_removed += len(plan.removed)
+        n_keys_ignored += len(plan.ignored)
+
+        if entries is not None:
+            entries.extend(inventory_entries(user,
+                    plan.result if (plan.added or plan.removed)
+                                    and not job.dry_run else ak))
+        # Did things change?
+        if not plan.added and not plan.removed:
+            raw_aks.append(None)
+            digests.append(hashlib.sha256(original_raw_ak).hexdigest())
+            continue
+        changes.append((user,
+                sorted(key_label(entry, job.policy) for entry in plan.added),
+                sorted(key_label(entry, job.policy)
+                            for entry in plan.removed)))
+        if job.dry_run and job.no_diff:
+            # Nobody will look at the new file.
+            raw_aks.append(None)
+            digests.append(None)
+            continue
+        raw_ak = six.binary_type(plan.result)
+        stopwatch.lap('serialize')
+        if not job.dry_run:
+            raw_aks.append(raw_ak)
+            digests.append(hashlib.sha256(raw_ak).hexdigest())
+            continue
+        raw_aks.append(None)
+        digests.append(None)
+        if not job.no_diff:
+            label = server['name']
+            if len(server['users']) > 1:
+                label = '{0} ({1})'.format(label, user)
+            diffs.append(''.join(difflib.unified_diff(
+                        original_raw_ak.decode('utf-8').splitlines(True),
+                        raw_ak.decode('utf-8').splitlines(True),
+                        label)))
+            stopwatch.lap('diff')
+
+    result = JobResult(n_keys_added=n_keys_added,
+                       n_keys_removed=n_keys_removed,
+                       n_keys_ignored=n_keys_ignored,
+                       remote_digest=None if None in digests
+                                        else combine_digests(digests),
+                       diff=''.join(diffs) if diffs else None,
+                       paths=None,
+                       changes=changes,
+                       entries=entries)
+    return raw_aks, result
+
+def key_label(entry, policy):
+    """ Returns how to refer to the key of entry in a report: by its name
+        in the configuration file, or else by its fingerprint and
+        comment. """
+    name = policy.names.get(entry.canonical_key)
+    if name is not None:
+        return name
+    label = entry.fingerprint
+    if entry.comment:
+        label += ' ' + entry.comment.decode('utf-8', 'replace')
+    return label
+
+def inventory_entries(user, ak):
+    """ Returns the entries of the AuthorizedKeysFile ak of user, as they
+        are recorded in the claviger.inventory: tuples (user, fingerprint,
+        keytype, comment, options). """
+    def text(b):
+        return None if b is None else b.decode('utf-8', 'replace')
+    return [(user, entry.fingerprint,
+             text(entry.keytype), text(entry.comment), text(entry.options))
+                for entry in ak.entries]